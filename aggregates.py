@@ -0,0 +1,128 @@
+import math
+import hashlib
+from bisect import bisect_right
+from records import *
+
+#running aggregates for streaming mode. every page of tracks is folded in as
+#it arrives and then dropped, so what is kept per user stays the same size no
+#matter how big the library is, but for artist_counts which has an entry per
+#distinct artist. everything here is plain dicts, lists and bytes so it can
+#live in the session
+
+bloom_bits = 2**20 #128 KB, misses about 1 in 150 new tracks at 100k tracks
+bloom_hashes = 7
+bins = 20
+edges = [i * (1 / bins) for i in range(bins + 1)] #as np.linspace makes them
+
+histogram_names = ["valence", "energy", "danceability", "popularity"]
+
+def new_aggregates():
+    return {
+        "seen":bytes(bloom_bits // 8), #bloom filter of the track keys folded so far
+        "artists_seen":bytes(bloom_bits // 8), #and of the artist ids queued or resolved
+        "tracks":0,
+        "artists":0,
+        "artist_counts":{},
+        "genre_counts":{},
+        "histograms":{name:{"counts":[0]*bins, "sum":0, "squares":0, "n":0} for name in histogram_names},
+        "feature_sums":[0]*len(FEATURE_FIELDS), #for the average feature vector, n is the valence histogram's
+        "pending_features":[], #track ids waiting for a full batch of audio features
+        "pending_artists":[], #artist ids waiting for a full batch of artists
+    }
+
+
+
+
+def bloom_positions(key):
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i*h2) % bloom_bits for i in range(bloom_hashes)]
+
+def bloom_add(bits, key):
+    #True if key wasn't in the filter yet
+    new = False
+    for position in bloom_positions(key):
+        byte, bit = divmod(position, 8)
+        if not bits[byte] & (1 << bit):
+            bits[byte] |= 1 << bit
+            new = True
+    return new
+
+def bloom_contains(bits, key):
+    #sometimes True for a key never added, never False for one that was
+    return all(bits[position // 8] & (1 << position % 8) for position in bloom_positions(key))
+
+def add_to_histogram(histogram, value):
+    #same bins as np.histogram over [0, 1], the last one includes 1
+    if 0 <= value <= 1:
+        histogram["counts"][min(bisect_right(edges, value) - 1, bins - 1)] += 1
+    histogram["sum"] += value
+    histogram["squares"] += value * value
+    histogram["n"] += 1
+
+def histogram_quantile(counts, q):
+    #interpolated within the bin it falls in, the values themselves are gone
+    target = q * sum(counts)
+    below = 0
+    for i, count in enumerate(counts):
+        if count and below + count >= target:
+            return edges[i] + (target - below) / count * (edges[i+1] - edges[i])
+        below += count
+    return edges[-1]
+
+def summarize(histogram):
+    #counts, mean, standard deviation, n and quartiles, like columns.summarize_columns
+    n = histogram["n"]
+    if not n:
+        #nothing to summarize, nan like numpy gives summarize_columns
+        return histogram["counts"], math.nan, math.nan, 0, [math.nan] * 3
+    mean = histogram["sum"] / n
+    std = max(0, histogram["squares"] / n - mean * mean) ** 0.5
+    return histogram["counts"], mean, std, n, [histogram_quantile(histogram["counts"], q) for q in [0.25, 0.5, 0.75]]
+
+
+
+
+def queue_artists(aggregates, artist_ids):
+    #artists not seen before wait in pending_artists to be resolved
+    bits = bytearray(aggregates["artists_seen"])
+    aggregates["pending_artists"].extend(artist_id for artist_id in artist_ids if artist_id and bloom_add(bits, artist_id))
+    aggregates["artists_seen"] = bytes(bits)
+
+def fold_records(aggregates, records, resolve_artists=True):
+    #records is {track key: track record}, tracks already folded are skipped
+    bits = bytearray(aggregates["seen"])
+    artist_counts = aggregates["artist_counts"]
+    artist_ids = []
+    for key, record in records.items():
+        if not bloom_add(bits, key):
+            continue
+        aggregates["tracks"] += 1
+        for name in record[TRACK_ARTIST_NAMES]:
+            artist_counts[name] = artist_counts.get(name, 0) + 1
+        artist_ids.extend(record[TRACK_ARTIST_IDS])
+        if record[TRACK_POPULARITY]: #don't count local tracks w/o ratings
+            add_to_histogram(aggregates["histograms"]["popularity"], record[TRACK_POPULARITY]/100)
+        if not is_local(key):
+            aggregates["pending_features"].append(key)
+    aggregates["seen"] = bytes(bits)
+    if resolve_artists:
+        queue_artists(aggregates, artist_ids)
+
+def fold_features(aggregates, vectors):
+    sums = aggregates["feature_sums"]
+    for vector in vectors:
+        for i, value in enumerate(vector):
+            sums[i] += value
+        add_to_histogram(aggregates["histograms"]["valence"], vector[VALENCE])
+        add_to_histogram(aggregates["histograms"]["energy"], vector[ENERGY])
+        add_to_histogram(aggregates["histograms"]["danceability"], vector[DANCEABILITY])
+
+def fold_genres(aggregates, artists):
+    #artists is {artist id: artist record}, each artist is only folded once by collect_artists
+    genre_counts = aggregates["genre_counts"]
+    for artist in artists.values():
+        aggregates["artists"] += 1
+        for genre in artist[ARTIST_GENRES]:
+            genre_counts[genre] = genre_counts.get(genre, 0) + 1
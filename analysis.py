@@ -1,21 +1,44 @@
-import json
+import math
+import random
 import requests
-import io
-import base64
+import spotify
+import metrics
+import population
+import recommender
+import library
+import genres
+from budget import Budget
 import numpy as np
 import time
-from urllib.parse import quote
-import matplotlib.pyplot as plt
 from collections import Counter
-
-plt.switch_backend('Agg')
-
-time_limit = 20 #need to avoid 30 sec timeout on heroku
-
-base = "https://api.spotify.com/v1"
-
-def collect_top(method_data, plot_data):
+from cache import DiskCache
+from records import *
+from aggregates import *
+from columns import *
+
+base = spotify.base
+
+pages_per_round = 32 #most pages fetched at once, fewer when the budget is running out
+prefetch_interval = 0.25 #seconds between looks for newly collected tracks
+recommendations_window = 5 #seconds spotify's /recommendations may take, charts are drawn in the same request
+#all we read from a playlist page, spotify leaves out the rest (albums, markets, images...)
+playlist_fields = "total,items(track(id,uri,name,popularity,artists(id,name)))"
+
+#artist records shared across users, genres rarely change so a week is fine
+artist_cache = DiskCache("artists", ttl=7*24*60*60, max_entries=200000)
+#audio features of a track never change, so these are kept until evicted
+feature_cache = DiskCache("audio_features", max_entries=2000000)
+#what each user's library and playlists held on their last visit, so a return
+#visit only fetches what changed since
+snapshot_cache = DiskCache("snapshots", ttl=30*24*60*60, max_entries=20000)
+#track ids of playlists by their snapshot_id, shared across users since many
+#follow the same editorial playlists, and the records of the tracks on them
+playlist_cache = DiskCache("playlists", max_bytes=256*2**20)
+track_cache = DiskCache("tracks", ttl=7*24*60*60, max_entries=2000000)
+
+def collect_top(method_data, plot_data, budget=None):
     
+    budget = budget or Budget(method_data["page_latency"])
     auth_header = method_data["auth_header"]
     incomplete_data = False
 
@@ -33,34 +56,48 @@ def collect_top(method_data, plot_data):
     artists = [long_term_artists, medium_term_artists, short_term_artists]
 
     #get user info
-    user_name, user_image, inc_data1 = get_user_info(incomplete_data, auth_header)
+    user_name, user_image, user_id, inc_data1 = get_user_info(incomplete_data, auth_header, budget.deadline)
     #get top tracks
-    track_names, inc_data2 = get_top_tracks(tracks, all_tracks, incomplete_data, auth_header)
+    track_names, inc_data2 = get_top_tracks(tracks, all_tracks, incomplete_data, auth_header, budget.deadline)
     #get top artists
-    artist_names, inc_data3 = get_top_artists(artists, all_artists, incomplete_data, auth_header)
+    artist_names, inc_data3 = get_top_artists(artists, all_artists, incomplete_data, auth_header, budget.deadline)
     incomplete_data == (inc_data1 or inc_data2 or inc_data3)
 
     plot_data["user_name"] = user_name
     plot_data["user_image"] = user_image
     plot_data["top_tracks"] = track_names
+    plot_data["charts"] = {} #chart specs, rendered all at once by render_charts
 
     method_data["incomplete_data_status"] = incomplete_data
+    method_data["user_id"] = user_id
     method_data["all_tracks"] = all_tracks
     method_data["tracks"] =  tracks
     method_data["artists"] = artists
     method_data["all_artists"] = all_artists
     method_data["artist_names"] = artist_names
+    #ids of every artist seen on a track, resolved to full artists once collection is done.
+    #streaming mode queues them in its aggregates instead, see fetch_pending_artists
+    method_data["artist_ids"] = {}
+    if method_data["streaming"]:
+        method_data["aggregates"] = new_aggregates()
+        fold_genres(method_data["aggregates"], all_artists)
+        queue_artists(method_data["aggregates"], all_artists)
+        method_data["aggregates"]["pending_artists"] = [] #already resolved
+    else:
+        method_data["resolved_artist_ids"] = dict.fromkeys(artist_id for term in artists for artist_id in term)
 
 
 
 
-def get_user_info(incomplete_data, auth_header):
+def get_user_info(incomplete_data, auth_header, deadline=None):
     user_name = "username"
     user_image = "../static/media/blank_profile.png"
+    user_id = None
     # get user info
-    response = requests.get(base + "/me", headers=auth_header)
+    response = spotify.get(base + "/me", headers=auth_header, deadline=deadline)
     if response.status_code == requests.codes.ok:
-        user = json.loads(response.text)
+        user = spotify.loads(response)
+        user_id = user["id"]
         if user["display_name"]:
                 user_name = user["display_name"]
         try:
@@ -71,134 +108,369 @@ def get_user_info(incomplete_data, auth_header):
     else:
         print("Failed to retrieve user profile data")
         incomplete_data = True
-    return user_name, user_image, incomplete_data
+    return user_name, user_image, user_id, incomplete_data
 
 
 
 
-def get_top_tracks(tracks, all_tracks, incomplete_data, auth_header):
+def get_top_tracks(tracks, all_tracks, incomplete_data, auth_header, deadline=None):
     #get top tracks
     for i,term in enumerate(["long_term", "medium_term", "short_term"]):
-        response = requests.get(base + "/me/top/tracks", params={"time_range":term, "limit":25}, headers=auth_header)
+        response = spotify.get(base + "/me/top/tracks", params={"time_range":term, "limit":25}, headers=auth_header, deadline=deadline)
         if response.status_code == requests.codes.ok:
-            tracks_data = json.loads(response.text)["items"]
-            tracks[i].extend([{track["name"]:track} for track in tracks_data])
-            for track in tracks[i]:
-                all_tracks.update(track)
+            tracks_data = spotify.loads(response)["items"]
+            tracks[i].extend([track_key(track) for track in tracks_data])
+            all_tracks.update({track_key(track):track_record(track) for track in tracks_data})
         else:
             print("Failed to retrieve {} top tracks".format(term))
             incomplete_data = True 
-    l_t_names = [list(track.keys())[0] for track in tracks[0]]
-    m_t_names = [list(track.keys())[0] for track in tracks[1]]
-    s_t_names = [list(track.keys())[0] for track in tracks[2]]
+    l_t_names = [all_tracks[track_id][TRACK_NAME] for track_id in tracks[0]]
+    m_t_names = [all_tracks[track_id][TRACK_NAME] for track_id in tracks[1]]
+    s_t_names = [all_tracks[track_id][TRACK_NAME] for track_id in tracks[2]]
     track_names = [l_t_names, m_t_names, s_t_names]
     return track_names, incomplete_data
 
 
 
 
-def get_top_artists(artists, all_artists, incomplete_data, auth_header):
+def get_top_artists(artists, all_artists, incomplete_data, auth_header, deadline=None):
     for i,term in enumerate(["long_term", "medium_term", "short_term"]):
-        response = requests.get(base + "/me/top/artists", params={"time_range":term, "limit":10}, headers=auth_header)
+        response = spotify.get(base + "/me/top/artists", params={"time_range":term, "limit":10}, headers=auth_header, deadline=deadline)
         if response.status_code == requests.codes.ok:
-            artist_data = json.loads(response.text)["items"]
-            artists[i].extend([{artist["name"]:artist} for artist in artist_data])
-            for artist in artists[i]:
-                all_artists.update(artist)
+            artist_data = spotify.loads(response)["items"]
+            artists[i].extend([artist["id"] for artist in artist_data])
+            all_artists.update({artist["id"]:artist_record(artist) for artist in artist_data})
         else:
             print("Failed to retrieve {} top artists".format(term))
             incomplete_data = True 
-    l_a_names = [list(artist.keys())[0] for artist in artists[0]]
-    m_a_names = [list(artist.keys())[0] for artist in artists[1]]
-    s_a_names = [list(artist.keys())[0] for artist in artists[2]]
+    l_a_names = [all_artists[artist_id][ARTIST_NAME] for artist_id in artists[0]]
+    m_a_names = [all_artists[artist_id][ARTIST_NAME] for artist_id in artists[1]]
+    s_a_names = [all_artists[artist_id][ARTIST_NAME] for artist_id in artists[2]]
     artist_names = [l_a_names, m_a_names, s_a_names]
     return artist_names, incomplete_data
 
 
 
 
-def collect_library(method_data):
+def collect_library(method_data, budget=None):
     
-    global time_limit
-    start_time = time.time()
+    budget = budget or Budget(method_data["page_latency"])
 
     auth_header = method_data["auth_header"]
     incomplete_data = method_data["incomplete_data_status"]
-    all_artists = method_data["all_artists"]
+    artist_ids = method_data["artist_ids"]
     all_tracks = method_data["all_tracks"]
 
-    collected = 0
+    #offsets of the pages still to fetch, known once the first page tells us the total
+    offsets = None
+    try:
+        offsets = method_data["library_offsets"]
+    except:
+        pass
+
+    #ids of the saved tracks, newest first, for the next snapshot
+    library_tracks = []
+    try:
+        library_tracks = method_data["library_tracks"]
+    except:
+        pass
+
+    #on a return visit, when the last snapshot was taken and how many tracks were saved since
+    since = None
+    new_count = 0
     try:
-        collected = method_data["num_tracks_collected"]
+        since = method_data["library_since"]
+        new_count = method_data["library_new_count"]
     except:
         pass
 
     #get all saved tracks in library
     collected_library = False
     while not collected_library:
-        if (time.time() - start_time) > time_limit:
-            method_data["num_tracks_collected"] = collected
+        round_size = budget.pages(pages_per_round)
+        if not round_size:
             break
-        response = requests.get(base + "/me/tracks", params={"limit":50, "offset":collected}, headers=auth_header)
-        if response.status_code == requests.codes.ok:
-            tracks_json = json.loads(response.text)
-            tracks_data = [track["track"] for track in tracks_json["items"]]
-            success = update_all_from_tracks(all_artists, all_tracks, tracks_data, auth_header)
-            if not success:
-                print("Failed to retrieve artists of saved tracks on batch {}".format(collected // 50))
-                incomplete_data = True
-            new = len(tracks_data)
-            collected += new
-            collected_library = new < 50
+        if offsets is None:
+            round_offsets = [0]
         else:
-            print("Failed to retrieve saved tracks on batch {}".format(collected // 50))
-            incomplete_data = True
-            collected_library = True #don't want to get stuck
+            round_offsets, offsets = offsets[:round_size], offsets[round_size:]
+        pages = [(base + "/me/tracks", {"limit":50, "offset":offset}) for offset in round_offsets]
+        for offset, response in zip(round_offsets, spotify.get_pages(pages, auth_header, budget.deadline)):
+            if response.status_code == requests.codes.ok:
+                tracks_json = spotify.loads(response)
+                total = tracks_json["total"]
+                items = tracks_json["items"]
+                if offsets is None:
+                    method_data["library_total"] = total
+                    method_data["library_added_at"] = items[0]["added_at"] if items else None
+                    previous = load_snapshot(method_data).get("library")
+                    if previous and previous["added_at"]:
+                        since = previous["added_at"]
+                        method_data["library_previous_total"] = previous["total"]
+                    #the rest can be fetched concurrently, unless we are walking back to the last snapshot
+                    offsets = page_offsets(total, 50, method_data["page_budget"])[1:]
+                tracks_data = [item["track"] for item in items]
+                update_all_from_tracks(method_data, artist_ids, all_tracks, tracks_data)
+                if not method_data["streaming"]:
+                    library_tracks.extend(track_key(track) for track in tracks_data if track)
+                if since is not None:
+                    #saved tracks come newest first, so stop at the first one we already know
+                    known = [item for item in items if item["added_at"] <= since]
+                    new_count += len(items) - len(known)
+                    if not known and offset + 50 < total:
+                        offsets = [offset + 50]
+                    else:
+                        #if nothing was removed, the rest is what we stored last time
+                        snapshot = load_snapshot(method_data)
+                        stored = snapshot.get("library", {}).get("tracks", [])
+                        merged = []
+                        if total == method_data["library_previous_total"] + new_count:
+                            merged = merge_stored_tracks(method_data, snapshot.get("tracks", {}), artist_ids, all_tracks, stored)
+                        if "library" in snapshot and len(merged) == len(stored):
+                            fresh = library_tracks[:len(library_tracks) - len([item for item in known if item["track"]])]
+                            library_tracks = fresh + merged
+                            offsets = []
+                        else:
+                            #tracks were removed since, fetch the rest of the library again
+                            offsets = page_offsets(total, 50)[offset // 50 + 1:]
+                        since = None
+            else:
+                print("Failed to retrieve saved tracks on batch {}".format(offset // 50))
+                incomplete_data = True
+                if offsets is None:
+                    offsets = [] #don't want to get stuck
+                elif since is not None:
+                    offsets = [] #can't tell where the last snapshot is
+                    since = None
+        incomplete_data = fetch_pending_features(method_data, deadline=budget.deadline) or incomplete_data
+        incomplete_data = fetch_pending_artists(method_data, deadline=budget.deadline) or incomplete_data
+        budget.observe(len(round_offsets))
+        collected_library = offsets is not None and not offsets
 
     method_data["incomplete_data_status"] = incomplete_data
-    method_data["all_artists"] = all_artists
+    method_data["artist_ids"] = artist_ids
     method_data["all_tracks"] = all_tracks
+    method_data["library_offsets"] = offsets
+    method_data["library_tracks"] = library_tracks
+    method_data["library_since"] = since
+    method_data["library_new_count"] = new_count
     method_data["collected_library"] = collected_library
+    method_data["page_latency"] = budget.latency
+
+
+
+
+def load_snapshot(method_data):
+    #what this user's library and playlists held on their last visit. a
+    #sample can't be compared with a snapshot, and streaming mode doesn't
+    #keep the track ids one is made of, so it is never used then
+    if method_data["page_budget"] or method_data["streaming"] or not method_data["user_id"]:
+        return {}
+    return snapshot_cache.get_many([method_data["user_id"]]).get(method_data["user_id"], {})
+
+def merge_stored_tracks(method_data, stored_tracks, artist_ids, all_tracks, track_ids):
+    #add stored track records as if they were just collected, returns the ids found
+    track_ids = [track_id for track_id in track_ids if track_id in stored_tracks]
+    if method_data["streaming"]:
+        fold_records(method_data["aggregates"], {track_id:stored_tracks[track_id] for track_id in track_ids})
+        return track_ids
+    for track_id in track_ids:
+        all_tracks[track_id] = stored_tracks[track_id]
+        artist_ids.update(dict.fromkeys(artist_id for artist_id in stored_tracks[track_id][TRACK_ARTIST_IDS] if artist_id))
+    return track_ids
+
+def playlist_key(playlist):
+    #a playlist's tracks only change along with its snapshot_id
+    return "{}:{}".format(playlist["id"], playlist["snapshot_id"])
+
+def save_playlists(method_data):
+    #share the playlists fetched in full with every other user following them
+    if method_data["page_budget"] or method_data["streaming"]:
+        return
+    all_tracks = method_data["all_tracks"]
+    playlist_data = method_data["playlist_data"]
+    playlist_tracks = method_data["playlist_tracks"]
+    fetched = dict.fromkeys(playlist_data[i]["id"] for i, offset in method_data["playlist_pages"])
+    playlists = {}
+    tracks = {}
+    for playlist in playlist_data:
+        if playlist["id"] in fetched and playlist["id"] not in method_data["failed_playlists"]:
+            track_ids = list(playlist_tracks.get(playlist["id"], {}))
+            playlists[playlist_key(playlist)] = track_ids
+            tracks.update({track_id:all_tracks[track_id][:TRACK_FEATURES] + [None] for track_id in track_ids if track_id in all_tracks})
+    track_cache.set_many(tracks)
+    playlist_cache.set_many(playlists)
+
+def save_snapshot(method_data):
+    #only complete, unsampled collections are worth comparing against next time
+    if method_data["page_budget"] or method_data["streaming"] or not method_data["user_id"] or method_data["incomplete_data_status"]:
+        return
+    all_tracks = method_data["all_tracks"]
+    playlist_tracks = method_data["playlist_tracks"]
+    playlists = {}
+    for playlist in method_data["playlist_data"]:
+        playlists[playlist["id"]] = {"snapshot_id":playlist["snapshot_id"], "tracks":list(playlist_tracks.get(playlist["id"], {}))}
+    track_ids = dict.fromkeys(method_data["library_tracks"])
+    for playlist in playlists.values():
+        track_ids.update(dict.fromkeys(playlist["tracks"]))
+    snapshot_cache.set_many({method_data["user_id"]:{
+        "library":{
+            "added_at":method_data["library_added_at"],
+            "total":method_data["library_total"],
+            "tracks":method_data["library_tracks"],
+        },
+        "playlists":playlists,
+        "tracks":{track_id:all_tracks[track_id][:TRACK_FEATURES] + [None] for track_id in track_ids if track_id in all_tracks},
+    }})
+
+
+
+
+def save_library(method_data, plot_data):
+    #the collected tracks and artists as column arrays, for download and offline analysis.
+    #needs every artist resolved and every track's features fetched
+    if method_data["streaming"] or not method_data["user_id"]:
+        return
+    try:
+        library.save(method_data["user_id"], method_data)
+    except OSError as error:
+        print("Library unavailable: {}".format(error))
+        return
+    plot_data["library_id"] = method_data["user_id"]
+
+
+
+
+def page_offsets(total, limit, budget=0):
+    #offset of every page, or of the first page and a random sample of the rest when over budget
+    offsets = list(range(0, total, limit))
+    if budget and len(offsets) > budget:
+        offsets = offsets[:1] + sorted(random.sample(offsets[1:], budget - 1))
+    return offsets
+
+
+
+
+def stratify(sizes, budget=0):
+    #split budget across strata in proportion to their sizes. fractional
+    #shares are settled by weighted sampling, so small strata still get a chance
+    if not budget or sum(sizes) <= budget:
+        return list(sizes)
+    shares = [budget * size / sum(sizes) for size in sizes]
+    allocation = [int(share) for share in shares]
+    remainders = [i for i, share in enumerate(shares) if share > int(share)]
+    remainders.sort(key=lambda i: random.random() ** (1 / (shares[i] - allocation[i])), reverse=True)
+    for i in remainders[:budget - sum(allocation)]:
+        allocation[i] += 1
+    return allocation
 
 
-def update_all_from_tracks(all_artists, all_tracks, tracks_data, auth_header):
-    #if not tracks, do nothing
-    if not tracks_data:
-        return True
+
+
+def sample_playlist_pages(playlist_data, budget=0):
+    #[playlist index, offset] of each page to fetch, sampled per playlist when over budget
+    page_counts = [math.ceil(playlist["tracks"]["total"] / 100) for playlist in playlist_data]
+    pages = []
+    for i, (count, allocated) in enumerate(zip(page_counts, stratify(page_counts, budget))):
+        offsets = list(range(0, 100*count, 100))
+        if allocated < count:
+            offsets = sorted(random.sample(offsets, allocated))
+        pages.extend([i, offset] for offset in offsets)
+    return pages
+
+
+def update_all_from_tracks(method_data, artist_ids, all_tracks, tracks_data):
+    #unavailable items come back without a track
+    tracks_data = [track for track in tracks_data if track]
+    if method_data["streaming"]:
+        fold_records(method_data["aggregates"], {track_key(track):track_record(track) for track in tracks_data})
+        return
     #add tracks to tracks collection
-    [all_tracks.update({track["name"]:track}) for track in tracks_data]
-    #add track authors to artist collection
-    artist_ids = []
-    success = True
+    all_tracks.update({track_key(track):track_record(track) for track in tracks_data})
+    #note track authors, full artists are fetched once everything is collected
     for track in tracks_data:
-        artist_data = track["artists"]
-        artist_ids.extend([artist["id"] for artist in artist_data])
+        artist_ids.update(dict.fromkeys(artist["id"] for artist in track["artists"] if artist["id"]))
+
+
+
+
+def add_artists(method_data, all_artists, artists):
+    #in streaming mode only their genres are kept, top artists are already in all_artists
+    if method_data["streaming"]:
+        fold_genres(method_data["aggregates"], artists)
+    else:
+        all_artists.update(artists)
+
+
+
+
+def collect_artists(method_data, budget=None):
+
+    budget = budget or Budget(method_data["page_latency"])
+
+    auth_header = method_data["auth_header"]
+    incomplete_data = method_data["incomplete_data_status"]
+    all_artists = method_data["all_artists"]
+    if method_data["streaming"]:
+        #most were resolved as they were collected, only the last part batch is left
+        resolved_artist_ids = {}
+        artist_ids = method_data["aggregates"]["pending_artists"]
+    else:
+        resolved_artist_ids = method_data["resolved_artist_ids"]
+        artist_ids = [artist_id for artist_id in method_data["artist_ids"] if artist_id not in resolved_artist_ids]
+
     #get full artist object (because genres aren't included in simple)
-    while artist_ids:
+    cached = artist_cache.get_many(artist_ids)
+    add_artists(method_data, all_artists, cached)
+    resolved_artist_ids.update(dict.fromkeys(cached))
+    artist_ids = [artist_id for artist_id in artist_ids if artist_id not in cached]
+
+    collected_artists = False
+    while not collected_artists:
+        round_size = budget.pages(pages_per_round)
+        if not round_size:
+            break
         #can only request 50 at a time
-        artist_ids_str = str(artist_ids[:50]).replace(" ", "").replace("'","")[1:-1]
-        artist_ids = artist_ids[50:]
-        artist_response = requests.get(base + "/artists", params={"ids":artist_ids_str}, headers=auth_header)
-        if artist_response.status_code == requests.codes.ok:
-            artist_data = json.loads(artist_response.text)["artists"]
-            for artist in artist_data:
-                if artist:
-                    all_artists.update({artist["name"]:artist})
-        else:
-            success = False
-    return success
+        batches = [artist_ids[i:i+50] for i in range(0, len(artist_ids), 50)][:round_size]
+        pages = [(base + "/artists", {"ids":",".join(batch)}) for batch in batches]
+        for batch, artist_response in zip(batches, spotify.get_pages(pages, auth_header, budget.deadline)):
+            if artist_response.status_code == requests.codes.ok:
+                artist_data = {artist["id"]:artist_record(artist) for artist in spotify.loads(artist_response)["artists"] if artist}
+                add_artists(method_data, all_artists, artist_data)
+                artist_cache.set_many(artist_data)
+            else:
+                print("Failed to retrieve a batch of artists")
+                incomplete_data = True
+            resolved_artist_ids.update(dict.fromkeys(batch))
+        artist_ids = artist_ids[50*len(batches):]
+        budget.observe(len(batches))
+        collected_artists = not artist_ids
+
+    #only ever set, in a background job this can run alongside other stages
+    if incomplete_data:
+        method_data["incomplete_data_status"] = True
+    method_data["all_artists"] = all_artists
+    if method_data["streaming"]:
+        method_data["aggregates"]["pending_artists"] = artist_ids
+    elif collected_artists:
+        #every artist is in all_artists now, no need to carry their ids through the session
+        method_data.pop("artist_ids", None)
+        method_data.pop("resolved_artist_ids", None)
+    else:
+        method_data["resolved_artist_ids"] = resolved_artist_ids
+    method_data["collected_artists"] = collected_artists
+    method_data["page_latency"] = budget.latency
 
 
 
 
-def collect_playlists(method_data):
+def collect_playlists(method_data, budget=None):
     
-    global time_limit
-    start_time = time.time()
+    budget = budget or Budget(method_data["page_latency"])
 
     auth_header = method_data["auth_header"]
     incomplete_data = method_data["incomplete_data_status"]
-    all_artists = method_data["all_artists"]
+    artist_ids = method_data["artist_ids"]
     all_tracks = method_data["all_tracks"]
 
     collected = 0
@@ -207,6 +479,12 @@ def collect_playlists(method_data):
     except:
         pass
 
+    total = None
+    try:
+        total = method_data["playlists_total"]
+    except:
+        pass
+
     collected_playlists = False
     try:
         collected_playlists = method_data["collected_playlists"]
@@ -220,77 +498,162 @@ def collect_playlists(method_data):
         pass
 
     while not collected_playlists:
-        if (time.time() - start_time) > time_limit:
-            method_data["num_playlists_collected"] = collected
+        round_size = budget.pages(pages_per_round)
+        if not round_size:
             break
-        response = requests.get(base + "/me/playlists", params={"limit":50, "offset":collected}, headers=auth_header)
-        if response.status_code == requests.codes.ok:
-            new_playlist_data = json.loads(response.text)["items"]
-            playlist_data.extend(new_playlist_data)
-            new = len(new_playlist_data)
-            collected += new
-            collected_playlists = new < 50
+        if total is None:
+            offsets = [collected]
         else:
-            print("Failed to retrieve a playlist")
-            incomplete_data = True
-            collected_playlists = True #don't want to get stuck
+            offsets = list(range(collected, total, 50))[:round_size]
+        pages = [(base + "/me/playlists", {"limit":50, "offset":offset}) for offset in offsets]
+        for response in spotify.get_pages(pages, auth_header, budget.deadline):
+            if response.status_code == requests.codes.ok:
+                playlists_json = spotify.loads(response)
+                total = playlists_json["total"]
+                playlist_data.extend(playlists_json["items"])
+            else:
+                print("Failed to retrieve a playlist")
+                incomplete_data = True
+                if total is None:
+                    total = 0 #don't want to get stuck
+        if offsets:
+            collected = offsets[-1] + 50
+        budget.observe(len(offsets))
+        collected_playlists = collected >= total
 
     collected_tracks = True #if wrongfully true, then collected_playlists is false
     if collected_playlists:
 
-        i_playlist = 0
-        incomplete_playlist = False
+        #pages to fetch across all playlists, in order, so we can pick up where we left off
+        playlist_pages = None
+        try:
+            playlist_pages = method_data["playlist_pages"]
+        except:
+            pass
+        #ids of each playlist's tracks, for the next snapshot
+        playlist_tracks = {}
+        failed_playlists = {}
+        try:
+            playlist_tracks = method_data["playlist_tracks"]
+            failed_playlists = method_data["failed_playlists"]
+        except:
+            pass
+
+        if playlist_pages is None:
+            #playlists that haven't changed since the last snapshot are taken from it
+            snapshot = load_snapshot(method_data)
+            stored_playlists = snapshot.get("playlists", {})
+            for playlist in playlist_data:
+                stored = stored_playlists.get(playlist["id"])
+                if stored and stored["snapshot_id"] == playlist["snapshot_id"]:
+                    merged = merge_stored_tracks(method_data, snapshot.get("tracks", {}), artist_ids, all_tracks, stored["tracks"])
+                    if len(merged) == len(stored["tracks"]):
+                        playlist_tracks[playlist["id"]] = dict.fromkeys(merged)
+            #then those someone else already fetched at the same snapshot_id
+            keys = {playlist["id"]:playlist_key(playlist) for playlist in playlist_data if playlist["id"] not in playlist_tracks}
+            cached_playlists = playlist_cache.get_many(keys.values())
+            cached_tracks = track_cache.get_many(dict.fromkeys(track_id for track_ids in cached_playlists.values() for track_id in track_ids))
+            for playlist_id, key in keys.items():
+                if key in cached_playlists:
+                    merged = merge_stored_tracks(method_data, cached_tracks, artist_ids, all_tracks, cached_playlists[key])
+                    if len(merged) == len(cached_playlists[key]):
+                        playlist_tracks[playlist_id] = {} if method_data["streaming"] else dict.fromkeys(merged)
+            changed = [i for i, playlist in enumerate(playlist_data) if playlist["id"] not in playlist_tracks]
+            playlist_pages = [[changed[i], offset] for i, offset in sample_playlist_pages([playlist_data[i] for i in changed], method_data["page_budget"])]
+            method_data["playlist_tracks_total"] = sum(playlist["tracks"]["total"] for playlist in playlist_data)
+
+        pages_collected = 0
         try:
-            i_playlist = method_data["i_playlist"]
-            incomplete_playlist = True
+            pages_collected = method_data["playlist_pages_collected"]
         except:
             pass
-        
-        for playlist in playlist_data[i_playlist:]:
-            href = playlist["tracks"]["href"]
-            if incomplete_playlist:
-                href = method_data["next_href"]
-                incomplete_playlist = False
-            while href:
-                if (time.time() - start_time) > time_limit:
-                    method_data["next_href"] = href
-                    method_data["i_playlist"] = i_playlist
-                    collected_tracks = False
-                    break
-                tracks_response = requests.get(href, headers=auth_header)
+
+        while pages_collected < len(playlist_pages):
+            round_size = budget.pages(pages_per_round)
+            if not round_size:
+                collected_tracks = False
+                break
+            round_pages = playlist_pages[pages_collected:pages_collected + round_size]
+            pages = [(playlist_data[i]["tracks"]["href"], {"limit":100, "offset":offset, "fields":playlist_fields}) for i, offset in round_pages]
+            for (i, offset), tracks_response in zip(round_pages, spotify.get_pages(pages, auth_header, budget.deadline)):
                 if tracks_response.status_code == requests.codes.ok:
-                    tracks_json = json.loads(tracks_response.text)
-                    href = tracks_json["next"]
+                    tracks_json = spotify.loads(tracks_response)
                     tracks_data = [track["track"] for track in tracks_json["items"]]
-                    success = update_all_from_tracks(all_artists, all_tracks, tracks_data, auth_header)
-                    if not success:
-                        print("Failed to retrieve artists from some tracks")
-                        incomplete_data = True
+                    update_all_from_tracks(method_data, artist_ids, all_tracks, tracks_data)
+                    if not method_data["streaming"]:
+                        playlist_tracks.setdefault(playlist_data[i]["id"], {}).update(dict.fromkeys(track_key(track) for track in tracks_data if track))
                 else:
                     print("Failed to retrieve additional tracks from playlist")
                     incomplete_data = True
-            if not collected_tracks:
-                break
-            i_playlist += 1
+                    failed_playlists[playlist_data[i]["id"]] = None
+            pages_collected += len(round_pages)
+            incomplete_data = fetch_pending_features(method_data, deadline=budget.deadline) or incomplete_data
+            incomplete_data = fetch_pending_artists(method_data, deadline=budget.deadline) or incomplete_data
+            budget.observe(len(round_pages))
+        method_data["playlist_pages"] = playlist_pages
+        method_data["playlist_pages_collected"] = pages_collected
+        method_data["playlist_tracks"] = playlist_tracks
+        method_data["failed_playlists"] = failed_playlists
     
     method_data["incomplete_data_status"] = incomplete_data
-    method_data["all_artists"] = all_artists
+    method_data["artist_ids"] = artist_ids
     method_data["all_tracks"] = all_tracks
+    method_data["num_playlists_collected"] = collected
+    method_data["playlists_total"] = total
     method_data["collected_tracks"] = collected_tracks
     method_data["collected_playlists"] = collected_playlists
     method_data["playlist_data"] = playlist_data
+    method_data["page_latency"] = budget.latency
+    if collected_playlists and collected_tracks:
+        if method_data["streaming"]:
+            #top tracks stay in all_tracks for their names and are counted last, so only
+            #those also saved or on a playlist have their artists resolved, as in the full analysis
+            fold_records(method_data["aggregates"], all_tracks, resolve_artists=False)
+        save_snapshot(method_data)
+        save_playlists(method_data)
+
+
+
+
+def sample_fraction(method_data):
+    #share of the user's tracks we actually looked at, 1 unless sampling kicked in
+    if not method_data["page_budget"]:
+        return 1
+    population = method_data.get("library_total", 0) + method_data.get("playlist_tracks_total", 0)
+    return min(1, track_count(method_data) / population) if population else 1
+
+def track_count(method_data):
+    #distinct tracks collected
+    if method_data["streaming"]:
+        return method_data["aggregates"]["tracks"]
+    return len(method_data["all_tracks"])
+
+def margin_of_error(std, n, fraction):
+    #half width of a 95% interval for an estimate from n items, a fraction of the population.
+    #pages are sampled whole, so treat this as a lower bound
+    if n == 0 or fraction >= 1:
+        return 0
+    return 1.96 * std / math.sqrt(n) * math.sqrt(1 - fraction)
+
+def share_labels(ranked, n, fraction):
+    #legend entries for the 30 biggest shares of [(item, count)], most common first,
+    #with their margin of error when sampled
+    total = sum(count for _, count in ranked)
+    labels = []
+    for i,item in enumerate(ranked[:30]):
+        share = item[1]/total
+        label = "{}.  {} ({}%)".format(i+1, item[0], round(100*share, 2))
+        if fraction < 1:
+            label = "{}.  {} ({}% ± {}%)".format(i+1, item[0], round(100*share, 2), round(100*margin_of_error(math.sqrt(share*(1-share)), n, fraction), 2))
+        labels.append(label)
+    return labels
 
 
 
 
 def top_artists(method_data, plot_data):
-    plt.style.use('ggplot')
-    plt.rc("font", family="serif")
     l_a_names, m_a_names, s_a_names = method_data["artist_names"]
-    artist_set = set()
-    artist_set.update(l_a_names)
-    artist_set.update(m_a_names)
-    artist_set.update(s_a_names)
+    artist_set = dict.fromkeys(l_a_names + m_a_names + s_a_names)
     places_dict = {}
     count = max(len(l_a_names), len(m_a_names), len(s_a_names))
     for artist in artist_set:
@@ -301,42 +664,30 @@ def top_artists(method_data, plot_data):
             except:
                 places.append(count+1)
         places_dict[artist] = places
-    ha = {
-        0:"left",
-        1:"center",
-        2:"right"
+    plot_data["charts"]["top_artists_img"] = {
+        "kind":"bump",
+        "count":count,
+        "artists":list(places_dict),
+        "places":list(places_dict.values()),
     }
-    plt.figure(figsize=(10, 6))
-    plt.gca().set_prop_cycle('color', [plt.cm.tab20(i) for i in np.linspace(0,1,20)])
-    for artist in artist_set:
-        plt.plot(places_dict[artist])
-        for i,place in enumerate(places_dict[artist][::-1]):
-            if place <= count:
-                plt.annotate(artist, (2-i,place), ha=ha[2-i])
-                break
-    plt.yticks(list(range(1,count+1)))
-    plt.gca().yaxis.tick_right()
-    plt.xticks([0,1,2],["Long Term", "Medium Term", "Short Term"])
-    plt.gca().set_ylim([0.5,count+0.5])
-    plt.gca().invert_yaxis()
-    img = io.BytesIO()
-    plt.savefig(img, format='png', bbox_inches='tight')
-    plt.close()
-    img.seek(0)
-    artists_pic = quote(base64.b64encode(img.read()).decode())
-    plot_data["top_artists_img"] = artists_pic
 
 
 
 
 def top_genres(method_data, plot_data):
-    plt.style.use('ggplot')
-    plt.rc("font", family="serif")
     artists_terms_list = method_data["artists"]
     term_genres = [Counter(), Counter(), Counter()] #long, med, short
+    all_artists = method_data["all_artists"]
+    level = method_data["genre_level"]
     for i,term in enumerate(artists_terms_list):
-        for artist in term:
-            term_genres[i].update(artist[list(artist.keys())[0]]["genres"])
+        for artist_id in term:
+            term_genres[i].update(genres.lookup(genre, level) for genre in all_artists[artist_id][ARTIST_GENRES])
+    #a band for each of the most common overall, the rest stacked together
+    kept = dict(genres.roll_up((term_genres[0] + term_genres[1] + term_genres[2]).most_common(), "genre"))
+    for i,genre_counter in enumerate(term_genres):
+        term_genres[i] = Counter()
+        for genre, count in genre_counter.items():
+            term_genres[i][genre if genre in kept else genres.other] += count
     total_counts = [0,0,0]
     all_genres = set()
     for i,genre_counter in enumerate(term_genres):
@@ -355,133 +706,255 @@ def top_genres(method_data, plot_data):
                 props.append(0) #if no top genres for term (no top artists for term)
         genre_props.append(props)
     all_genres_list, genre_props = list(zip(*sorted(list(zip(all_genres_list, genre_props)), key=(lambda pair: pair[1][::-1]))))
-    plt.figure(figsize=(10, 6))
-    plt.gca().set_prop_cycle('color', [plt.cm.tab20(i) for i in np.linspace(0,1,20)])
-    plt.stackplot([0,1,2], *genre_props, labels=all_genres_list)
-    plt.gca().yaxis.tick_right()
-    plt.yticks([num/100 for num in range(0,100+1, 10)], [str(num)+"%" for num in range(0,100+1,10)])
-    plt.xticks([-0.75, 0,1,2],["", "Long Term", "Medium Term", "Short Term"])
-    plt.gca().set_ylim([0,1])
-    handles, labels = plt.gca().get_legend_handles_labels()
-    plt.gca().legend(handles[::-1][:29], labels[::-1][:29], loc='center left', fontsize=8)
-    img = io.BytesIO()
-    plt.savefig(img, format='png', bbox_inches='tight')
-    plt.close()
-    img.seek(0)
-    genres_stack_plot = quote(base64.b64encode(img.read()).decode())
-    plot_data["top_genres_img"] = genres_stack_plot
+    plot_data["charts"]["top_genres_img"] = {
+        "kind":"stack",
+        "genres":list(all_genres_list),
+        "props":list(genre_props),
+    }
 
 
 
 
 def genre_diversity(method_data, plot_data):
-    plt.style.use('ggplot')
-    plt.rc("font", family="serif")
     artists_dict = method_data["all_artists"]
-    genre_counts = Counter()
-    for artist_name in artists_dict:
-        artist = artists_dict[artist_name]
-        if artist["genres"]:
-            genre_counts.update(artist["genres"])
-    total = sum(genre_counts.values())
-    if total == 0:
+    artist_count = len(artists_dict)
+    if method_data["streaming"]:
+        ranked = Counter(method_data["aggregates"]["genre_counts"]).most_common()
+        artist_count = method_data["aggregates"]["artists"]
+    else:
+        columns = artist_columns(artists_dict)
+        ranked = ranked_counts(columns["genre_codes"], columns["genre_names"])
+    if not ranked:
         #hope this never happens
         print("No genres found")
         plot_data["genres_pie_chart"] = "NA"
     else:
-        labels, counts = list(zip(*[(genre, count) if count/total > 0.015 else ("", count) for genre, count in genre_counts.most_common()]))
-        plt.figure(figsize=(10, 6))
-        plt.gca().set_prop_cycle('color', [plt.cm.tab20(i) for i in np.linspace(0,1,20)])
-        plt.pie(counts, explode=[0.1]+[0]*(len(counts)-1), labels=labels, textprops={'fontsize': 9}, startangle=110)
-        plt.legend(fontsize=7, labels=["{}.  {} ({}%)".format(i+1, item[0], round(100*item[1]/total, 2)) for i,item in enumerate(genre_counts.most_common(30))], loc="upper right")
-        plt.gca().axis('equal')
-        img = io.BytesIO()
-        plt.savefig(img, format='png', bbox_inches='tight')
-        plt.close()
-        img.seek(0)
-        genres_pie_chart = quote(base64.b64encode(img.read()).decode())
-        plot_data["genres_pie_chart"] = genres_pie_chart
+        #one slice per family or style, the statistics below still count every genre
+        plot_data["charts"]["genres_pie_chart"] = pie_spec(genres.roll_up(ranked, method_data["genre_level"]), artist_count, sample_fraction(method_data))
+        plot_data["genre_diversity"] = diversity(ranked)
+        plot_data["genre_percentiles"] = population.compare("genre", ranked, population_user(method_data))
 
 
 
 
 def artist_diversity(method_data, plot_data):
-    plt.style.use('ggplot')
-    plt.rc("font", family="serif")
-    tracks_dict = method_data["all_tracks"]
-    artist_counts = Counter()
-    for track_name in tracks_dict:
-        track = tracks_dict[track_name]
-        artist_counts.update([artist["name"] for artist in track["artists"] if artist["name"]])
-    total = sum(artist_counts.values())
-    if total == 0:
+    if method_data["streaming"]:
+        ranked = Counter(method_data["aggregates"]["artist_counts"]).most_common()
+    else:
+        columns = track_columns(method_data["all_tracks"])
+        ranked = ranked_counts(columns["artist_codes"], columns["artist_names"])
+    if not ranked:
         #hope this never happens
         print("No artists found")
         plot_data["artists_pie_chart"] = "NA"
     else:
-        labels, counts = list(zip(*[(genre, count) if count/total > 0.015 else ("", count) for genre, count in artist_counts.most_common()]))
-        plt.figure(figsize=(10, 6))
-        plt.gca().set_prop_cycle('color', [plt.cm.tab20(i) for i in np.linspace(0,1,20)])
-        plt.pie(counts, explode=[0.1]+[0]*(len(counts)-1), labels=labels, textprops={'fontsize': 9}, startangle=110)
-        plt.legend(fontsize=7, labels=["{}.  {} ({}%)".format(i+1, item[0], round(100*item[1]/total, 2)) for i,item in enumerate(artist_counts.most_common(30))], loc="upper right")
-        plt.gca().axis('equal')
-        img = io.BytesIO()
-        plt.savefig(img, format='png', bbox_inches='tight')
-        plt.close()
-        img.seek(0)
-        artists_pie_chart = quote(base64.b64encode(img.read()).decode())
-        plot_data["artists_pie_chart"] = artists_pie_chart
+        plot_data["charts"]["artists_pie_chart"] = pie_spec(ranked, track_count(method_data), sample_fraction(method_data))
+        plot_data["artist_diversity"] = diversity(ranked)
+        plot_data["artist_percentiles"] = population.compare("artist", ranked, population_user(method_data))
 
 
 
 
-def features(method_data, plot_data):
-    plt.style.use('ggplot')
-    plt.rc("font", family="serif")
-    tracks_dict = method_data["all_tracks"]
-    incomplete_data = method_data["incomplete_data_status"]
-    auth_header = method_data["auth_header"]
+def population_user(method_data):
+    #only whole, complete libraries are added to the population, the rest are just compared with it
+    if method_data["page_budget"] or method_data["incomplete_data_status"]:
+        return None
+    return method_data["user_id"]
+
+def pie_spec(ranked, n, fraction):
+    #slices smaller than 1.5% go unlabelled
+    total = sum(count for _, count in ranked)
+    labels, counts = list(zip(*[(item, count) if count/total > 0.015 else ("", count) for item, count in ranked]))
+    return {
+        "kind":"pie",
+        "labels":list(labels),
+        "counts":list(counts),
+        "legend":share_labels(ranked, n, fraction),
+    }
+
+
+
 
-    valence = []
-    energy = []
-    danceability = []
-    popularity = []
-    ids_for_features = []
-    for track_name in tracks_dict:
-        track = tracks_dict[track_name]
-        if track["popularity"]: #don't count local tracks w/o ratings
-            popularity.append(track["popularity"]/100)
-        ids_for_features.append(track["id"])
-    #get features, 100 at a time
-    for i in range(0, len(ids_for_features), 100):
-        ids_str = str(ids_for_features[i:i+100]).replace(" ", "").replace("'","")[1:-1]
-        response = requests.get(base + "/audio-features", params={"ids":ids_str}, headers=auth_header)
+def get_feature_vectors(track_ids, auth_header, deadline=None):
+    #{track id: feature vector} and whether any batch failed. only asks
+    #spotify for features we haven't seen before, 100 at a time
+    feature_vectors = feature_cache.get_many(track_ids)
+    track_ids = [track_id for track_id in track_ids if track_id not in feature_vectors]
+    pages = [(base + "/audio-features", {"ids":",".join(track_ids[i:i+100])}) for i in range(0, len(track_ids), 100)]
+    fetched = {}
+    failed = False
+    for i, response in enumerate(spotify.get_pages(pages, auth_header, deadline)):
         if response.status_code == requests.codes.ok:
-            features = json.loads(response.text)["audio_features"]
-            for audio_object in features:
-                if audio_object:
-                    valence.append(audio_object["valence"])
-                    energy.append(audio_object["energy"])
-                    danceability.append(audio_object["danceability"])
+            features = spotify.loads(response)["audio_features"]
+            fetched.update({audio_object["id"]:feature_record(audio_object) for audio_object in features if audio_object})
         else:
-            incomplete_data = True
-            print("Failed to retrieve features on batch " + str(i//100))
-    imgs = []
+            failed = True
+            print("Failed to retrieve features on batch " + str(i))
+    feature_cache.set_many(fetched)
+    feature_vectors.update(fetched)
+    return feature_vectors, failed
+
+
+
+
+def prefetch_features(method_data, done):
+    #fetches audio features into the cache a full batch at a time while tracks are
+    #still being collected, until done() is true, so features() finds them there.
+    #failed batches are left for features() to retry
+    if method_data["streaming"]:
+        return #fetch_pending_features already does this as tracks are folded
+    requested = {}
+    while not done():
+        track_ids = [track_id for track_id in list(method_data["all_tracks"]) if track_id not in requested and not is_local(track_id)]
+        ready = len(track_ids) - len(track_ids) % 100
+        if ready:
+            requested.update(dict.fromkeys(track_ids[:ready]))
+            get_feature_vectors(track_ids[:ready], method_data["auth_header"])
+        else:
+            time.sleep(prefetch_interval)
+
+
+
+
+def fetch_pending_features(method_data, everything=False, deadline=None):
+    #streaming mode folds in features a full batch at a time while collecting,
+    #returns whether any batch failed
+    if not method_data["streaming"]:
+        return False
+    aggregates = method_data["aggregates"]
+    pending = aggregates["pending_features"]
+    ready = len(pending) if everything else len(pending) - len(pending) % 100
+    if not ready:
+        return False
+    feature_vectors, failed = get_feature_vectors(pending[:ready], method_data["auth_header"], deadline)
+    fold_features(aggregates, feature_vectors.values())
+    aggregates["pending_features"] = pending[ready:]
+    return failed
+
+
+
+
+def fetch_pending_artists(method_data, deadline=None):
+    #streaming mode resolves artists a full batch at a time while collecting too,
+    #so only those waiting for a batch are kept. returns whether any batch failed
+    if not method_data["streaming"]:
+        return False
+    aggregates = method_data["aggregates"]
+    pending = aggregates["pending_artists"]
+    ready = len(pending) - len(pending) % 50
+    if not ready:
+        return False
+    artists = artist_cache.get_many(pending[:ready])
+    artist_ids = [artist_id for artist_id in pending[:ready] if artist_id not in artists]
+    pages = [(base + "/artists", {"ids":",".join(artist_ids[i:i+50])}) for i in range(0, len(artist_ids), 50)]
+    fetched = {}
+    failed = False
+    for response in spotify.get_pages(pages, method_data["auth_header"], deadline):
+        if response.status_code == requests.codes.ok:
+            fetched.update({artist["id"]:artist_record(artist) for artist in spotify.loads(response)["artists"] if artist})
+        else:
+            print("Failed to retrieve a batch of artists")
+            failed = True
+    artist_cache.set_many(fetched)
+    artists.update(fetched)
+    fold_genres(aggregates, artists)
+    aggregates["pending_artists"] = pending[ready:]
+    return failed
+
+
+
+
+def collect_features(method_data, budget=None):
+    #audio features of every collected track that doesn't have them yet, in
+    #rounds like the other collectors so /loading6 can checkpoint between them
+
+    budget = budget or Budget(method_data["page_latency"])
+    incomplete_data = False
+
+    if method_data["streaming"]:
+        #all but the last part batch were fetched while collecting
+        budget.pages(1)
+        incomplete_data = fetch_pending_features(method_data, everything=True, deadline=budget.deadline)
+        budget.observe(1)
+        collected_features = True
+    else:
+        tracks_dict = method_data["all_tracks"]
+        #tracks spotify had no features for, or whose batch failed, aren't asked for again
+        missing_features = method_data.get("missing_features", {})
+        track_ids = [track_id for track_id, record in tracks_dict.items() if record[TRACK_FEATURES] is None and not is_local(track_id) and track_id not in missing_features]
+        #most were prefetched by a background job, or are known from other users
+        cached = feature_cache.get_many(track_ids)
+        for track_id, vector in cached.items():
+            tracks_dict[track_id][TRACK_FEATURES] = vector
+        track_ids = [track_id for track_id in track_ids if track_id not in cached]
+        collected_features = not track_ids
+        while not collected_features:
+            round_size = budget.pages(pages_per_round)
+            if not round_size:
+                break
+            round_ids = track_ids[:100*round_size]
+            feature_vectors, failed = get_feature_vectors(round_ids, method_data["auth_header"], budget.deadline)
+            incomplete_data = failed or incomplete_data
+            for track_id in round_ids:
+                if track_id in feature_vectors:
+                    tracks_dict[track_id][TRACK_FEATURES] = feature_vectors[track_id]
+                else:
+                    missing_features[track_id] = None
+            track_ids = track_ids[len(round_ids):]
+            budget.observe(math.ceil(len(round_ids) / 100))
+            collected_features = not track_ids
+        if collected_features:
+            method_data.pop("missing_features", None)
+        else:
+            method_data["missing_features"] = missing_features
+
+    #only ever set, in a background job this can run alongside other stages
+    if incomplete_data:
+        method_data["incomplete_data_status"] = True
+    method_data["collected_features"] = collected_features
+    method_data["page_latency"] = budget.latency
+
+
+
+
+def features(method_data, plot_data):
+    #collect_features has fetched what there is to fetch
+    tracks_dict = method_data["all_tracks"]
+
+    if method_data["streaming"]:
+        aggregates = method_data["aggregates"]
+        summaries = [summarize(aggregates["histograms"][name]) for name in histogram_names]
+        n = aggregates["histograms"]["valence"]["n"]
+        method_data["feature_centroid"] = [total / n for total in aggregates["feature_sums"]] if n else None
+    else:
+        recommender.add(tracks_dict)
+        columns = track_columns(tracks_dict)
+        have_features = ~np.isnan(columns["features"][:, VALENCE])
+        method_data["feature_centroid"] = columns["features"][have_features].mean(axis=0).tolist() if have_features.any() else None
+        popularity = columns["popularity"] / 100
+        popularity[popularity == 0] = np.nan #don't count local tracks w/o ratings
+        summaries = summarize_columns(np.column_stack([columns["features"][:, [VALENCE, ENERGY, DANCEABILITY]], popularity]))
     means = []
+    margins = []
+    quartiles = []
+    fraction = sample_fraction(method_data)
     #make histograms
-    for category in [valence, energy, danceability, popularity]:
-        plt.figure(figsize=(10, 6))
-        plt.hist(category, range=(0,1), bins=20, color='#8D7EF2')
-        img = io.BytesIO()
-        plt.savefig(img, format='png', bbox_inches='tight')
-        plt.close()
-        img.seek(0)
-        imgs.append(quote(base64.b64encode(img.read()).decode()))
-        means.append(round(sum(category)/len(category), 2))
-
-    plot_data["features_imgs"] = imgs
+    for key, (counts, mean, std, n, category_quartiles) in zip(["valence_img", "energy_img", "danceability_img", "popularity_img"], summaries):
+        plot_data["charts"][key] = {
+            "kind":"hist",
+            "range":[0,1],
+            "counts":counts,
+        }
+        means.append(round(mean, 2))
+        margins.append(round(margin_of_error(std, n, fraction), 3))
+        quartiles.append([round(quartile, 2) for quartile in category_quartiles])
+
     plot_data["feature_means"] = means
-    method_data["incomplete_data_status"] = incomplete_data
+    plot_data["feature_quartiles"] = quartiles
+    #only shown when the means are estimated from a sample
+    plot_data["feature_margins"] = margins if fraction < 1 else None
+    if fraction < 1:
+        plot_data["sample_msg"] = "Estimated from a random sample of about {}% of your tracks.".format(max(1, round(100*fraction)))
 
 
 
@@ -492,9 +965,18 @@ def recommendations(method_data, plot_data):
     auth_header = method_data["auth_header"]
     means = plot_data["feature_means"]
 
+    #nearest the user's average among tracks analyzed here, spotify's otherwise
+    if method_data["streaming"]:
+        seen = method_data["aggregates"]["seen"]
+        saved = lambda track_id: bloom_contains(seen, track_id)
+    else:
+        saved = lambda track_id: track_id in method_data["all_tracks"]
+    plot_data["recommendations"] = recommender.recommend(method_data["feature_centroid"], saved)
+    if plot_data["recommendations"]:
+        return
+
     #top 5 artists, short term prioritized
     artists = artists[2]+artists[1]+artists[0]
-    artists = [artist[list(artist.keys())[0]]["id"] for artist in artists]
     seed_artists = sorted(list(set(artists)), key=(lambda artist:artists.index(artist)))[:5]
     params = {
         "seed_artists" :seed_artists,
@@ -502,8 +984,21 @@ def recommendations(method_data, plot_data):
         "target_energy" : means[1],
         "target_danceability" : means[2],
     }
-    plot_data["recommendations"] = []
-    response = requests.get(base + "/recommendations", params=params, headers=auth_header)
+    response = spotify.get(base + "/recommendations", params=params, headers=auth_header, deadline=time.time() + recommendations_window)
     if response.status_code == requests.codes.ok:
-        tracks = json.loads(response.text)["tracks"]
+        tracks = spotify.loads(response)["tracks"]
         plot_data["recommendations"] =  [[track["name"], ", ".join([artist["name"] for artist in track["artists"]])] for track in tracks]
+
+
+
+
+def render_charts(method_data, plot_data):
+    #in client mode the browser draws the specs itself
+    if method_data["chart_mode"] == "client":
+        return
+    #matplotlib is only imported by workers that draw charts
+    from rendering import render_all
+    #every chart at once, so this takes about as long as the slowest one
+    start = time.time()
+    plot_data.update(render_all(plot_data.pop("charts")))
+    metrics.observe("polyvibe_chart_render_seconds", time.time() - start, charts="analysis")
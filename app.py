@@ -1,9 +1,15 @@
+import io
+import os
 import json
+import time
 import requests
+import jobs
+import library
+import metrics
 from analysis import *
 from urllib.parse import quote
 from flask_session import Session
-from flask import Flask, request, redirect, render_template, url_for, session
+from flask import Flask, request, redirect, render_template, url_for, session, jsonify, abort, Response
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "this is going on github anyways"
@@ -16,11 +22,48 @@ secret_id = "e4dfa6dc0c844256b57b3c2bc73176ea"
 redirect_uri = "https://polyvibe.herokuapp.com/callback"
 scope = "user-top-read playlist-read-private playlist-read-collaborative user-library-read"
 
+#run the whole analysis as one background job instead of the /loadingN chain
+background_jobs = os.environ.get("POLYVIBE_BACKGROUND_JOBS") == "1"
+#"png" renders charts on the server, "client" sends their data for the browser to draw
+chart_mode = os.environ.get("POLYVIBE_CHART_MODE", "png")
+#most pages fetched from the library, and from all playlists, 0 fetches everything
+page_budget = int(os.environ.get("POLYVIBE_SAMPLE_PAGES", 0))
+#fold tracks into running aggregates as they arrive instead of keeping them all
+streaming = os.environ.get("POLYVIBE_STREAMING") == "1"
+#how finely genre charts are split: "genre", "style" or "family", see genres.py
+genre_level = os.environ.get("POLYVIBE_GENRE_LEVEL", "style")
+
+def new_method_data(access_token):
+    return {
+        "auth_header" : {"Authorization" : "Bearer " + access_token},
+        "chart_mode" : chart_mode,
+        "page_budget" : page_budget,
+        "streaming" : streaming,
+        "genre_level" : genre_level,
+        "page_latency" : None, #seconds per wave of pages, carried from one request's budget to the next
+        "metrics" : metrics.new_tally(),
+    }
+
+@app.before_request
+def track_analysis():
+    #spotify calls and stage timings of the /loadingN chain add up in the session
+    method_data = session.get("method_data")
+    metrics.track(method_data.get("metrics") if method_data else None)
+
+def analysis_failed(error):
+    print(type(error))
+    print(error.args)
+    print(error)
+    if "method_data" in session:
+        metrics.finish(session["method_data"].pop("metrics", None), mode="chain", status="failed", error=repr(error))
+    return render_template("error.html")
+
 @app.route("/")
 def index():
     session.pop("access_key", None)
     session.pop("method_data", None)
     session.pop("plot_data", None)
+    session.pop("job_id", None)
     return render_template("index.html")
 
 @app.route("/authorization")
@@ -49,6 +92,9 @@ def getInfo():
         }
         response = requests.post("https://accounts.spotify.com/api/token", data=post_data)
         session["access_token"] = json.loads(response.text)["access_token"]
+        if background_jobs:
+            session["job_id"] = jobs.enqueue(new_method_data(session["access_token"]))
+            return render_template("loading.html", job_id=session["job_id"], msg="Collecting your top songs...")
         return render_template("loading.html", action="/loading1", msg="Collecting your top songs...")
     except:
         return render_template("error.html")
@@ -62,86 +108,138 @@ def getInfo():
 def loading1():
     try:
         session["plot_data"] = {}
-        session["method_data"] = {"auth_header" : {"Authorization" : "Bearer " + session["access_token"]}}
-        collect_top(session["method_data"], session["plot_data"])
+        session["method_data"] = new_method_data(session["access_token"])
+        metrics.track(session["method_data"]["metrics"])
+        with metrics.stage("collect_top"):
+            collect_top(session["method_data"], session["plot_data"])
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
     return render_template("loading.html", action="/loading2", msg="Collecting your saved tracks...")
 
 @app.route("/loading2")
 def loading2():
     try:
-        collect_library(session["method_data"])
+        with metrics.stage("collect_library"):
+            collect_library(session["method_data"])
         if session["method_data"]["collected_library"]:
             return render_template("loading.html", action="/loading3", msg="Collecting your playlists...")
         else:
             return redirect(url_for("loading2"))
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
 
 @app.route("/loading3")
 def loading3():
     try:
-        collect_playlists(session["method_data"])
-        if session["method_data"]["collected_playlists"] and session["method_data"]["collected_tracks"]:
-            return render_template("loading.html", action="/loading4", msg="Analyzing your artists...")
+        method_data = session["method_data"]
+        #artists are resolved in one go once every playlist track is collected
+        if method_data.get("collected_playlists") and method_data.get("collected_tracks"):
+            with metrics.stage("collect_artists"):
+                collect_artists(method_data)
+            if method_data["collected_artists"]:
+                return render_template("loading.html", action="/loading4", msg="Analyzing your artists...")
         else:
-            return redirect(url_for("loading3"))
+            with metrics.stage("collect_playlists"):
+                collect_playlists(method_data)
+        return redirect(url_for("loading3"))
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
 
 @app.route("/loading4")
 def loading4():
     try:
-        top_artists(session["method_data"], session["plot_data"])
-        artist_diversity(session["method_data"], session["plot_data"])
+        with metrics.stage("analyze_artists"):
+            top_artists(session["method_data"], session["plot_data"])
+            artist_diversity(session["method_data"], session["plot_data"])
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
     return render_template("loading.html", action="/loading5", msg="Analyzing your genres...")
 
 @app.route("/loading5")
 def loading5():
     try:
-        top_genres(session["method_data"], session["plot_data"])
-        genre_diversity(session["method_data"], session["plot_data"])
+        with metrics.stage("analyze_genres"):
+            top_genres(session["method_data"], session["plot_data"])
+            genre_diversity(session["method_data"], session["plot_data"])
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
     return render_template("loading.html", action="/loading6", msg="Analyzing your tracks...")
 
 @app.route("/loading6")
 def loading6():
     try:
-        features(session["method_data"], session["plot_data"])
-        recommendations(session["method_data"], session["plot_data"])
+        with metrics.stage("collect_features"):
+            collect_features(session["method_data"])
+        if session["method_data"]["collected_features"]:
+            return render_template("loading.html", action="/loading7", msg="Drawing your charts...")
+        return redirect(url_for("loading6"))
     except Exception as error:
-        print(type(error))
-        print(error.args)
-        print(error)
-        return render_template("error.html")
+        return analysis_failed(error)
+
+@app.route("/loading7")
+def loading7():
+    try:
+        with metrics.stage("analyze_tracks"):
+            features(session["method_data"], session["plot_data"])
+            recommendations(session["method_data"], session["plot_data"])
+            render_charts(session["method_data"], session["plot_data"])
+            save_library(session["method_data"], session["plot_data"])
+        tally = session["method_data"].pop("metrics", None)
+        metrics.observe("polyvibe_session_bytes", len(app.session_interface.serializer.encode(dict(session))), store="session")
+        metrics.finish(tally, mode="chain", status="done", incomplete=session["method_data"]["incomplete_data_status"])
+    except Exception as error:
+        return analysis_failed(error)
     return redirect(url_for("display"))
 
+@app.route("/progress/<job_id>")
+def progress(job_id):
+    job_progress = jobs.get_progress(job_id)
+    if job_progress is None:
+        abort(404)
+    return jsonify(job_progress)
+
+def get_plot_data():
+    #(plot_data, incomplete_data) of this user's finished analysis
+    if "job_id" in session:
+        return jobs.get_result(session["job_id"])
+    return session["plot_data"], session["method_data"]["incomplete_data_status"]
+
+@app.route("/export/library.zip")
+def export_library():
+    #the user's saved library, as python library.py would bundle it
+    plot_data, _ = get_plot_data()
+    if plot_data is None or not plot_data.get("library_id") or library.load(plot_data["library_id"]) is None:
+        abort(404)
+    archive = io.BytesIO()
+    library.export(archive, [plot_data["library_id"]])
+    return Response(archive.getvalue(), mimetype="application/zip", headers={"Content-Disposition":"attachment; filename=library.zip"})
+
+@app.route("/export/<chart>.png")
+def export(chart):
+    #png of a chart drawn in the browser
+    plot_data, _ = get_plot_data()
+    if plot_data is None or chart not in plot_data.get("charts", {}):
+        abort(404)
+    from rendering import render_png
+    start = time.time()
+    png = render_png(plot_data["charts"][chart])
+    metrics.observe("polyvibe_chart_render_seconds", time.time() - start, charts="export")
+    return Response(png, mimetype="image/png")
+
 @app.route("/display")
 def display():
-    if session["method_data"]["incomplete_data_status"]:
-        session["plot_data"]["incomplete_data_msg"] = "Note: We encountered issues when collecting your data. The quality of this report may have been impacted."
+    plot_data, incomplete_data = get_plot_data()
+    if plot_data is None:
+        return render_template("error.html")
+    if incomplete_data:
+        plot_data["incomplete_data_msg"] = "Note: We encountered issues when collecting your data. The quality of this report may have been impacted."
     else:
-        session["plot_data"]["incomplete_data_msg"] = ""
-    return render_template("analysis.html", info=session["plot_data"])
+        plot_data["incomplete_data_msg"] = ""
+    return render_template("analysis.html", info=plot_data)
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
 
 if __name__ == '__main__':
     app.run(debug=True, use_reloader=True)
\ No newline at end of file
@@ -0,0 +1,306 @@
+import time
+import random
+import threading
+from collections import Counter
+from flask import Flask, request, jsonify, abort
+
+#a stand-in for the parts of the spotify web api polyvibe uses. users are
+#synthetic and picked by access token: "bench-5000" has 5000 saved tracks.
+#tracks, artists and playlists come from shared catalogs, so users overlap
+#the way real ones do, and everything is generated deterministically
+
+catalog_tracks = 1000000
+catalog_artists = 50000
+editorial_playlists = 5 #followed by every user
+
+genre_bases = ["pop", "rock", "hip hop", "rap", "house", "techno", "jazz", "soul", "r&b", "folk",
+    "country", "metal", "punk", "indie", "edm", "trap", "lo-fi", "classical", "reggae", "blues"]
+genre_prefixes = ["", "indie", "uk", "dark", "dream", "alternative", "art", "chamber", "deep", "progressive",
+    "modern", "latin", "k-", "j-", "french", "bedroom", "neo", "post-", "underground", "melodic"]
+genres = sorted(set((prefix + ("" if prefix.endswith("-") or not prefix else " ") + genre_base) for prefix in genre_prefixes for genre_base in genre_bases))
+markets = ["AD", "AR", "AT", "AU", "BE", "BG", "BO", "BR", "CA", "CH", "CL", "CO", "CR", "CY", "CZ", "DE", "DK", "DO",
+    "EC", "EE", "ES", "FI", "FR", "GB", "GR", "GT", "HK", "HN", "HU", "ID", "IE", "IL", "IS", "IT", "JP", "LI", "LT",
+    "LU", "LV", "MC", "MT", "MX", "MY", "NI", "NL", "NO", "NZ", "PA", "PE", "PH", "PL", "PT", "PY", "RO", "SE", "SG",
+    "SK", "SV", "TH", "TR", "TW", "US", "UY", "VN", "ZA"]
+
+
+
+
+def skewed(r, n):
+    #a few items are very popular, most are not
+    return int(n * r.random()**3)
+
+def artist_object(k):
+    r = random.Random("artist{}".format(k))
+    return {
+        "id":"artist{}".format(k),
+        "name":"Artist {}".format(k),
+        "type":"artist",
+        "uri":"spotify:artist:artist{}".format(k),
+        "href":"https://api.spotify.com/v1/artists/artist{}".format(k),
+        "external_urls":{"spotify":"https://open.spotify.com/artist/artist{}".format(k)},
+        "genres":r.sample(genres, r.choice([0, 1, 2, 3, 4])),
+        "popularity":r.randint(0, 100),
+        "followers":{"href":None, "total":r.randint(0, 10**7)},
+        "images":[{"url":"https://i.scdn.co/image/{}".format(r.getrandbits(64)), "height":size, "width":size} for size in [640, 300, 64]],
+    }
+
+def simple_artist(k):
+    artist = artist_object(k)
+    return {key:artist[key] for key in ["id", "name", "type", "uri", "href", "external_urls"]}
+
+def track_object(k):
+    #what a full track looks like, album and markets included
+    r = random.Random("track{}".format(k))
+    artists = [simple_artist(skewed(r, catalog_artists)) for _ in range(r.choice([1, 1, 1, 2, 3]))]
+    return {
+        "id":"track{}".format(k),
+        "name":"Track {}".format(k % 20000), #names repeat, like covers and remasters
+        "type":"track",
+        "uri":"spotify:track:track{}".format(k),
+        "href":"https://api.spotify.com/v1/tracks/track{}".format(k),
+        "popularity":r.randint(0, 100),
+        "duration_ms":r.randint(90000, 400000),
+        "explicit":r.random() < 0.2,
+        "is_local":False,
+        "track_number":r.randint(1, 12),
+        "disc_number":1,
+        "preview_url":"https://p.scdn.co/mp3-preview/{}".format(r.getrandbits(64)),
+        "external_ids":{"isrc":"US{}".format(r.getrandbits(32))},
+        "external_urls":{"spotify":"https://open.spotify.com/track/track{}".format(k)},
+        "available_markets":markets,
+        "artists":artists,
+        "album":{
+            "id":"album{}".format(k // 10),
+            "name":"Album {}".format(k // 10),
+            "album_type":"album",
+            "release_date":"{}-01-01".format(r.randint(1960, 2024)),
+            "total_tracks":12,
+            "artists":artists[:1],
+            "available_markets":markets,
+            "images":[{"url":"https://i.scdn.co/image/{}".format(r.getrandbits(64)), "height":size, "width":size} for size in [640, 300, 64]],
+            "external_urls":{"spotify":"https://open.spotify.com/album/album{}".format(k // 10)},
+        },
+    }
+
+def audio_features(k):
+    r = random.Random("features{}".format(k))
+    return {
+        "id":"track{}".format(k),
+        "type":"audio_features",
+        "valence":r.random(),
+        "energy":r.betavariate(3, 2),
+        "danceability":r.betavariate(4, 3),
+        "acousticness":r.random()**2,
+        "instrumentalness":r.random()**4,
+        "liveness":r.random()**3,
+        "speechiness":r.random()**4,
+        "loudness":r.uniform(-30, 0),
+        "tempo":r.uniform(60, 200),
+        "key":r.randint(0, 11),
+        "mode":r.randint(0, 1),
+        "time_signature":4,
+        "duration_ms":r.randint(90000, 400000),
+    }
+
+def track_number(track_id):
+    if not track_id.startswith("track") or not track_id[5:].isdigit():
+        return None
+    return int(track_id[5:])
+
+def artist_number(artist_id):
+    if not artist_id.startswith("artist") or not artist_id[6:].isdigit():
+        return None
+    return int(artist_id[6:])
+
+
+
+
+def parse_fields(fields):
+    #"a,b(c,d(e))" -> {"a":None, "b":{"c":None, "d":{"e":None}}}
+    tree = {}
+    stack = [tree]
+    name = ""
+    for char in fields + ",":
+        if char == "(":
+            stack[-1][name] = {}
+            stack.append(stack[-1][name])
+        elif char in ",)":
+            if name:
+                stack[-1][name] = None
+            if char == ")":
+                stack.pop()
+        else:
+            name += char
+            continue
+        name = ""
+    return tree
+
+def project(value, tree):
+    #keep only the fields asked for, lists are projected item by item
+    if tree is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    return {key:project(value[key], tree[key]) for key in tree if key in value}
+
+
+
+
+class User:
+    #a synthetic listener with size saved tracks and playlists to match
+
+    def __init__(self, size):
+        self.size = size
+        r = random.Random("user{}".format(size))
+        library = {}
+        while len(library) < size:
+            library[skewed(r, catalog_tracks)] = None
+        self.library = list(library)
+        #newest first, like /me/tracks
+        self.added_at = ["{:04d}-{:02d}-{:02d}T00:00:00Z".format(2024 - i // 5000, 12 - (i // 400) % 12, 28 - (i // 15) % 28) for i in range(size)]
+        self.playlists = {}
+        for j in range(max(1, size // 300)):
+            tracks = [skewed(r, catalog_tracks) for _ in range(r.randint(10, 400))]
+            self.playlists["user{}list{}".format(size, j)] = ("snapshot0", tracks)
+        for j in range(editorial_playlists):
+            er = random.Random("editorial{}".format(j))
+            self.playlists["editorial{}".format(j)] = ("snapshot0", [skewed(er, catalog_tracks // 10) for _ in range(er.randint(100, 500))])
+
+
+
+
+def create_app(latency=0.0, rate_429=0.0, retry_after=1):
+    #latency is the mean seconds added to every response, rate_429 the share
+    #of requests turned away with a Retry-After
+    app = Flask(__name__)
+    users = {}
+    users_lock = threading.Lock()
+    stats = {"calls":Counter(), "bytes":Counter(), "statuses":Counter()}
+    stats_lock = threading.Lock()
+
+    def endpoint():
+        parts = request.path.split("/")
+        if len(parts) > 3 and parts[2] == "playlists":
+            return "/playlists/{id}/tracks"
+        return request.path[len("/v1"):]
+
+    def user():
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        if not token.startswith("bench-"):
+            abort(401)
+        size = int(token[len("bench-"):])
+        with users_lock:
+            if size not in users:
+                users[size] = User(size)
+            return users[size]
+
+    def page(items, limit_default=20, limit_max=50):
+        offset = int(request.args.get("offset", 0))
+        limit = min(int(request.args.get("limit", limit_default)), limit_max)
+        next_href = None
+        if offset + limit < len(items):
+            next_href = "{}?offset={}&limit={}".format(request.base_url, offset + limit, limit)
+        return {
+            "href":request.url,
+            "items":items[offset:offset+limit],
+            "limit":limit,
+            "offset":offset,
+            "total":len(items),
+            "next":next_href,
+            "previous":None,
+        }, offset, limit
+
+    @app.before_request
+    def before():
+        if latency:
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+        if rate_429 and random.random() < rate_429:
+            response = jsonify({"error":{"status":429, "message":"API rate limit exceeded"}})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(retry_after)
+            return response
+
+    @app.after_request
+    def after(response):
+        with stats_lock:
+            stats["calls"][endpoint()] += 1
+            stats["bytes"][endpoint()] += len(response.get_data())
+            stats["statuses"][response.status_code] += 1
+        return response
+
+    @app.route("/v1/me")
+    def me():
+        current = user()
+        return jsonify({"id":"bench{}".format(current.size), "display_name":"Bench {}".format(current.size), "images":[]})
+
+    @app.route("/v1/me/top/<kind>")
+    def top(kind):
+        current = user()
+        limit = int(request.args.get("limit", 20))
+        shift = {"long_term":0, "medium_term":7, "short_term":13}[request.args.get("time_range", "medium_term")]
+        if kind == "tracks":
+            items = [track_object(k) for k in current.library[shift:shift+limit]]
+        else:
+            items = [artist_object(artist_number(track_object(k)["artists"][0]["id"])) for k in current.library[shift:shift+limit*3]]
+            items = list({artist["id"]:artist for artist in items}.values())[:limit]
+        return jsonify({"items":items, "total":len(items), "limit":limit, "offset":0})
+
+    @app.route("/v1/me/tracks")
+    def saved_tracks():
+        current = user()
+        body, offset, limit = page(current.library)
+        body["items"] = [{"added_at":current.added_at[offset+i], "track":track_object(k)} for i, k in enumerate(body["items"])]
+        return jsonify(body)
+
+    @app.route("/v1/me/playlists")
+    def playlists():
+        current = user()
+        body, offset, limit = page(list(current.playlists))
+        body["items"] = [{
+            "id":playlist_id,
+            "name":playlist_id,
+            "snapshot_id":current.playlists[playlist_id][0],
+            "collaborative":False,
+            "public":True,
+            "owner":{"id":"bench{}".format(current.size), "display_name":"Bench"},
+            "images":[{"url":"https://mosaic.scdn.co/640/{}".format(playlist_id), "height":640, "width":640}],
+            "tracks":{"href":"{}/v1/playlists/{}/tracks".format(request.host_url.rstrip("/"), playlist_id), "total":len(current.playlists[playlist_id][1])},
+        } for playlist_id in body["items"]]
+        return jsonify(body)
+
+    @app.route("/v1/playlists/<playlist_id>/tracks")
+    def playlist_tracks(playlist_id):
+        current = user()
+        if playlist_id not in current.playlists:
+            abort(404)
+        body, offset, limit = page(current.playlists[playlist_id][1], 100, 100)
+        body["items"] = [{"added_at":"2020-01-01T00:00:00Z", "is_local":False, "track":track_object(k)} for k in body["items"]]
+        if "fields" in request.args:
+            body = project(body, parse_fields(request.args["fields"]))
+        return jsonify(body)
+
+    @app.route("/v1/artists")
+    def artists():
+        user()
+        ids = request.args["ids"].split(",")
+        if len(ids) > 50:
+            abort(400)
+        return jsonify({"artists":[artist_object(artist_number(i)) if artist_number(i) is not None else None for i in ids]})
+
+    @app.route("/v1/audio-features")
+    def features():
+        user()
+        ids = request.args["ids"].split(",")
+        if len(ids) > 100:
+            abort(400)
+        return jsonify({"audio_features":[audio_features(track_number(i)) if track_number(i) is not None else None for i in ids]})
+
+    @app.route("/v1/recommendations")
+    def recommendations():
+        user()
+        r = random.Random(request.query_string)
+        return jsonify({"tracks":[track_object(skewed(r, catalog_tracks)) for _ in range(20)], "seeds":[]})
+
+    app.stats = stats
+    return app
@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import json
+import shutil
+import pickle
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import threading
+from collections import Counter
+from werkzeug.serving import make_server
+
+#runs the analysis pipeline and the app routes against the mock spotify api
+#for synthetic users of a few sizes, and reports where the time goes.
+#
+#   python benchmarks/run.py --tracks 100 1000 10000 --latency 0.05
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mock_spotify
+
+def start_mock(latency, rate_429):
+    mock = mock_spotify.create_app(latency=latency, rate_429=rate_429)
+    server = make_server("127.0.0.1", 0, mock, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return mock, "http://127.0.0.1:{}/v1".format(server.server_port)
+
+def snapshot(mock):
+    return Counter(mock.stats["calls"]), Counter(mock.stats["bytes"])
+
+def difference(before, after):
+    calls = after[0] - before[0]
+    transferred = after[1] - before[1]
+    return calls, transferred
+
+
+
+
+def bench_pipeline(mock, size, memory):
+    import app
+    import jobs
+    method_data = app.new_method_data("bench-{}".format(size))
+    plot_data = {}
+    rows = []
+    for name, msg, share, stage, needs in jobs.stages:
+        before = snapshot(mock)
+        if memory:
+            tracemalloc.start()
+        start = time.time()
+        stage(method_data, plot_data)
+        wall = time.time() - start
+        peak = 0
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        calls, transferred = difference(before, snapshot(mock))
+        rows.append((name, wall, calls, transferred, peak))
+    session_size = len(pickle.dumps({"method_data":method_data, "plot_data":plot_data}))
+    return rows, session_size, method_data["incomplete_data_status"]
+
+def bench_scheduled(mock, size):
+    #the stages as a background job runs them, overlapping where they can
+    import app
+    import jobs
+    method_data = app.new_method_data("bench-{}".format(size))
+    before = snapshot(mock)
+    start = time.time()
+    jobs.run_stages(method_data, {})
+    wall = time.time() - start
+    calls, transferred = difference(before, snapshot(mock))
+    return wall, calls, transferred
+
+def bench_routes(mock, size):
+    #the /loadingN redirect chain, as the browser would walk it
+    import app
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["access_token"] = "bench-{}".format(size)
+    rows = Counter()
+    hops = Counter()
+    url = "/loading1"
+    while url:
+        start = time.time()
+        response = client.get(url)
+        rows[url] += time.time() - start
+        hops[url] += 1
+        body = response.get_data(as_text=True)
+        if response.status_code == 302:
+            url = response.headers["Location"]
+        elif "action=/loading" in body:
+            url = body.split("action=")[1].split(" ")[0]
+        elif url != "/display":
+            url = "/display"
+        else:
+            url = None
+    return rows, hops, len(body)
+
+
+
+
+def megabytes(count):
+    return "{:.2f} MB".format(count / 2**20)
+
+def report_pipeline(size, rows, session_size, incomplete_data):
+    print("\npipeline, {} saved tracks{}".format(size, " (incomplete)" if incomplete_data else ""))
+    print("{:<20}{:>10}{:>8}{:>14}{:>14}  {}".format("stage", "wall", "calls", "transferred", "peak memory", "calls by endpoint"))
+    for name, wall, calls, transferred, peak in rows:
+        by_endpoint = ", ".join("{} {}".format(endpoint, count) for endpoint, count in sorted(calls.items()))
+        print("{:<20}{:>9.2f}s{:>8}{:>14}{:>14}  {}".format(name, wall, sum(calls.values()), megabytes(sum(transferred.values())), megabytes(peak) if peak else "-", by_endpoint))
+    print("{:<20}{:>9.2f}s{:>8}{:>14}".format("total", sum(row[1] for row in rows), sum(sum(row[2].values()) for row in rows), megabytes(sum(sum(row[3].values()) for row in rows))))
+    print("session size: {}".format(megabytes(session_size)))
+
+def report_scheduled(size, wall, calls, transferred):
+    print("\nscheduled, {} saved tracks".format(size))
+    print("{:<20}{:>9.2f}s{:>8}{:>14}".format("total", wall, sum(calls.values()), megabytes(sum(transferred.values()))))
+
+def report_routes(size, rows, hops, page_size):
+    print("\nroutes, {} saved tracks".format(size))
+    for url in rows:
+        print("{:<20}{:>9.2f}s  {} request{}".format(url, rows[url], hops[url], "" if hops[url] == 1 else "s"))
+    print("{:<20}{:>9.2f}s".format("total", sum(rows.values())))
+    print("/display size: {}".format(megabytes(page_size)))
+
+def bench_size(args):
+    #runs in its own process, so caches start cold and memory is not shared between sizes
+    mock, base = start_mock(args.latency, args.rate_429)
+    os.environ["SPOTIFY_API_BASE"] = base
+    os.environ["POLYVIBE_SPOTIFY_RATE"] = str(args.rate)
+    os.environ["POLYVIBE_SPOTIFY_BURST"] = str(args.rate)
+
+    size = args.size
+    if args.scheduled:
+        if args.warm:
+            bench_scheduled(mock, size)
+        wall, calls, transferred = bench_scheduled(mock, size)
+        report_scheduled(size, wall, calls, transferred)
+        return {"tracks":size, "warm":args.warm, "scheduled":{"wall":wall, "calls":dict(calls), "bytes":dict(transferred)}}
+    if args.warm:
+        bench_pipeline(mock, size, False)
+    rows, session_size, incomplete_data = bench_pipeline(mock, size, args.memory)
+    report_pipeline(size, rows, session_size, incomplete_data)
+    result = {
+        "tracks":size,
+        "warm":args.warm,
+        "incomplete":incomplete_data,
+        "stages":[{"name":name, "wall":wall, "calls":dict(calls), "bytes":dict(transferred), "peak_memory":peak} for name, wall, calls, transferred, peak in rows],
+        "session_size":session_size,
+    }
+    if args.routes:
+        route_rows, hops, page_size = bench_routes(mock, size)
+        report_routes(size, route_rows, hops, page_size)
+        result["routes"] = {url:{"wall":route_rows[url], "requests":hops[url]} for url in route_rows}
+        result["display_size"] = page_size
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark polyvibe against a local stand-in for the spotify api")
+    parser.add_argument("--tracks", type=int, nargs="+", default=[100, 1000, 10000], help="saved tracks of each synthetic user")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean seconds added to every api response")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of api requests answered with 429")
+    parser.add_argument("--rate", type=float, default=1000, help="client side requests per second allowed")
+    parser.add_argument("--memory", action="store_true", help="trace peak memory per stage (slower)")
+    parser.add_argument("--routes", action="store_true", help="also walk the /loadingN routes")
+    parser.add_argument("--scheduled", action="store_true", help="run the stages as a background job does, overlapping them, instead of one after another")
+    parser.add_argument("--warm", action="store_true", help="measure a second run, once the caches are filled")
+    parser.add_argument("--json", help="also write the results here")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        #removed afterwards, the databases and libraries in it add up over runs
+        cache_dir = tempfile.mkdtemp(prefix="polyvibe-bench-")
+        os.environ["POLYVIBE_CACHE_DIR"] = cache_dir
+        os.chdir(cache_dir) #flask_session writes here too
+        try:
+            result = bench_size(args)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for size in args.tracks:
+        with tempfile.TemporaryDirectory(prefix="polyvibe-bench-") as result_dir:
+            result_path = os.path.join(result_dir, "result.json")
+            command = [sys.executable, os.path.abspath(__file__), "--size", str(size), "--result", result_path,
+                "--latency", str(args.latency), "--rate-429", str(args.rate_429), "--rate", str(args.rate)]
+            command += [flag for flag, enabled in [("--memory", args.memory), ("--routes", args.routes), ("--scheduled", args.scheduled), ("--warm", args.warm)] if enabled]
+            subprocess.run(command, check=True)
+            with open(result_path) as f:
+                results.append(json.load(f))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import math
+import time
+import spotify
+
+#how much of a request the collectors may spend on spotify. they fetch in rounds
+#of concurrent pages, and before each round the budget works out how many pages
+#fit in the time left from how long the rounds so far took, so a request uses
+#most of its window without running past heroku's 30 second limit. the
+#deadline goes with every page to spotify.get, which won't wait or retry past it
+
+window = 25 #seconds, what's left is for the session and the page
+smoothing = 0.3 #weight of the latest round in the latency estimate
+initial_latency = 1.0 #seconds per wave of concurrent pages, until a round is timed
+headroom = 1.5 #a round may take this much longer than estimated and still fit
+
+class Budget:
+    #one per request. latency carries the estimate over from the last request
+
+    def __init__(self, latency=None, seconds=window):
+        self.deadline = time.time() + seconds
+        self.latency = latency or initial_latency
+        self.rounds = 0
+        self.round_start = None
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def pages(self, wanted):
+        #how many of wanted pages to fetch in the next round, 0 means checkpoint now.
+        #the first round always gets a page, so every request makes progress
+        waves = int(self.remaining() / (self.latency * headroom))
+        pages = min(wanted, waves * spotify.max_workers)
+        if not self.rounds:
+            pages = max(pages, min(wanted, 1))
+        self.round_start = time.time()
+        return max(0, pages)
+
+    def observe(self, pages):
+        #the round of pages asked for by the last call to pages() is done
+        self.rounds += 1
+        if not pages:
+            return
+        waves = math.ceil(pages / spotify.max_workers)
+        latency = (time.time() - self.round_start) / waves
+        self.latency = smoothing * latency + (1 - smoothing) * self.latency
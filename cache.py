@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+cache_dir = os.environ.get("POLYVIBE_CACHE_DIR", "cache")
+
+max_variables = 500 #sqlite limits the number of ? in one statement
+evict_share = 0.01 #bounds are enforced after writes adding up to this share of them, counting and summing the whole table is a full scan
+
+created = set() #paths this process has already set up
+
+def open_db(path, schema, isolation_level=""):
+    #connection to an sqlite file shared by every worker on the machine. the first
+    #one in each process makes the directory, turns on WAL and runs schema, a list
+    #of statements, (statement, parameters) pairs or functions of the connection
+    first = path not in created
+    if first:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db = sqlite3.connect(path, timeout=30, isolation_level=isolation_level)
+    if first:
+        db.execute("PRAGMA journal_mode=WAL")
+        for statement in schema:
+            if callable(statement):
+                statement(db)
+            elif isinstance(statement, tuple):
+                db.execute(*statement)
+            else:
+                db.execute(statement)
+        db.commit()
+        created.add(path)
+    return db
+
+def add_size_column(db):
+    if "size" not in [column[1] for column in db.execute("PRAGMA table_info(cache)")]:
+        db.execute("ALTER TABLE cache ADD COLUMN size INTEGER DEFAULT 0") #caches from before max_bytes
+
+class DiskCache:
+    #json values keyed by string, shared by every worker through an sqlite file.
+    #entries older than ttl seconds are treated as missing and the least
+    #recently used entries are evicted once there are more than max_entries,
+    #or once their values add up to more than max_bytes. eviction runs every
+    #so many writes per worker, so a cache can go over its bounds by about evict_share
+
+    def __init__(self, name, ttl=None, max_entries=None, max_bytes=None):
+        self.path = os.path.join(cache_dir, name + ".db")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        #as if a bound was just reached, so the first write of each worker evicts
+        self.written_entries = max_entries or 0
+        self.written_bytes = max_bytes or 0
+
+    def connect(self):
+        return open_db(self.path, [
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, stored REAL, accessed REAL, size INTEGER)",
+            add_size_column,
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)",
+            "CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)",
+            "CREATE INDEX IF NOT EXISTS cache_accessed_size ON cache (accessed, size)", #sums sizes without reading values
+        ])
+
+    def get_many(self, keys):
+        #returns {key: value} for every key that is cached and not expired
+        found = {}
+        keys = list(keys)
+        if not keys:
+            return found
+        now = time.time()
+        oldest = now - self.ttl if self.ttl else 0
+        try:
+            with closing(self.connect()) as db, db:
+                for i in range(0, len(keys), max_variables):
+                    chunk = keys[i:i+max_variables]
+                    marks = ",".join("?" * len(chunk))
+                    rows = db.execute("SELECT key, value FROM cache WHERE stored >= ? AND key IN ({})".format(marks), [oldest] + chunk)
+                    hits = []
+                    for key, value in rows:
+                        found[key] = json.loads(value)
+                        hits.append(key)
+                    if hits:
+                        db.execute("UPDATE cache SET accessed = ? WHERE key IN ({})".format(",".join("?" * len(hits))), [now] + hits)
+        except sqlite3.Error as error:
+            print("Cache {} unavailable: {}".format(self.path, error))
+        return found
+
+    def set_many(self, items):
+        #items is {key: value}, values must be json serializable
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value, separators=(",", ":"))
+            rows.append((key, value, now, now, len(value)))
+        try:
+            with closing(self.connect()) as db, db:
+                db.executemany("INSERT OR REPLACE INTO cache (key, value, stored, accessed, size) VALUES (?, ?, ?, ?, ?)", rows)
+                self.written_entries += len(rows)
+                self.written_bytes += sum(row[4] for row in rows)
+                if self.due():
+                    self.evict(db, now)
+                    self.written_entries = self.written_bytes = 0
+        except sqlite3.Error as error:
+            print("Cache {} unavailable: {}".format(self.path, error))
+
+    def due(self):
+        if self.max_entries and self.written_entries >= self.max_entries * evict_share:
+            return True
+        if self.max_bytes and self.written_bytes >= self.max_bytes * evict_share:
+            return True
+        return not self.max_entries and not self.max_bytes #only a ttl, which is cheap to enforce
+
+    def evict(self, db, now):
+        if self.ttl:
+            db.execute("DELETE FROM cache WHERE stored < ?", (now - self.ttl,))
+        if self.max_entries:
+            excess = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+        if self.max_bytes:
+            if db.execute("SELECT TOTAL(size) FROM cache").fetchone()[0] > self.max_bytes:
+                #keep the most recently used entries that fit
+                db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS kept FROM cache) WHERE kept > ?)", (self.max_bytes,))
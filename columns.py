@@ -0,0 +1,75 @@
+import numpy as np
+from records import *
+
+#columnar views of the collected tracks and artists. they are built from the
+#records once per stage, so every statistic is a vectorized pass over arrays
+#instead of a loop over dicts. they never go in the session
+
+quantiles = [0.25, 0.5, 0.75]
+
+def encode(values):
+    #integer codes in order of first appearance, and the values they stand for
+    codes = {}
+    return np.array([codes.setdefault(value, len(codes)) for value in values], dtype=np.int64), list(codes)
+
+def track_columns(all_tracks):
+    records = list(all_tracks.values())
+    features = np.full((len(records), len(FEATURE_FIELDS)), np.nan)
+    for i, record in enumerate(records):
+        if record[TRACK_FEATURES]:
+            features[i] = record[TRACK_FEATURES]
+    artist_codes, artist_names = encode(name for record in records for name in record[TRACK_ARTIST_NAMES])
+    return {
+        "features":features, #one row per track, nan until its features are known
+        "popularity":np.array([record[TRACK_POPULARITY] or 0 for record in records], dtype=float),
+        #one entry per (track, artist) pair
+        "artist_codes":artist_codes,
+        "artist_names":artist_names,
+    }
+
+def artist_columns(all_artists):
+    genre_codes, genre_names = encode(genre for artist in all_artists.values() for genre in artist[ARTIST_GENRES])
+    return {
+        #one entry per (artist, genre) pair
+        "genre_codes":genre_codes,
+        "genre_names":genre_names,
+    }
+
+
+
+
+def ranked_counts(codes, names):
+    #[(name, count)] most common first, ties in order of first appearance like Counter.most_common
+    counts = np.bincount(codes, minlength=len(names))
+    order = np.argsort(-counts, kind="stable")
+    return [(names[i], int(counts[i])) for i in order]
+
+def entropy(counts):
+    #shannon entropy in bits
+    counts = np.asarray(counts, dtype=float)
+    p = counts[counts > 0] / counts.sum()
+    return float(-(p * np.log2(p)).sum())
+
+def gini(counts):
+    #0 when everything is equally common, close to 1 when one item has it all
+    counts = np.sort(np.asarray(counts, dtype=float))
+    n = len(counts)
+    return float(2 * (np.arange(1, n + 1) * counts).sum() / (n * counts.sum()) - (n + 1) / n)
+
+def diversity(ranked):
+    counts = [count for _, count in ranked]
+    return {"entropy":round(entropy(counts), 2), "gini":round(gini(counts), 2)}
+
+def summarize_columns(matrix, bins=20):
+    #(histogram counts, mean, std, n, quartiles) of each column in [0, 1], nans left out
+    n = (~np.isnan(matrix)).sum(axis=0)
+    means = np.nanmean(matrix, axis=0)
+    stds = np.nanstd(matrix, axis=0)
+    #numpy drops the column axis when there are no rows at all
+    quartiles = np.nanquantile(matrix, quantiles, axis=0) if len(matrix) else np.full((len(quantiles), matrix.shape[1]), np.nan)
+    summaries = []
+    for j in range(matrix.shape[1]):
+        column = matrix[:, j]
+        counts, _ = np.histogram(column[~np.isnan(column)], range=(0,1), bins=bins)
+        summaries.append((counts.tolist(), float(means[j]), float(stds[j]), int(n[j]), quartiles[:, j].tolist()))
+    return summaries
@@ -0,0 +1,83 @@
+import re
+from functools import lru_cache
+
+#rolls spotify's micro-genres up into the broad families they belong to, so
+#genre charts have a bounded number of slices however big the library is.
+#a genre is read as qualifiers followed by the family they narrow down:
+#
+#   "uk alternative hip hop"   style "alternative hip hop", family "hip hop"
+#   "progressive metalcore"    style "progressive metalcore", family "metal"
+#   "k-pop"                    style "k-pop", family "pop"
+#
+#genres without a known family are their own family
+
+#longer names first, so "hip hop" is found before "hop" could be and "trap" before "rap"
+families = sorted([
+    "pop", "rock", "metal", "punk", "emo", "indie", "hip hop", "rap", "trap", "drill", "grime",
+    "r&b", "soul", "funk", "disco", "jazz", "blues", "gospel", "folk", "country", "bluegrass",
+    "americana", "singer-songwriter", "reggae", "reggaeton", "dancehall", "ska", "latin", "salsa",
+    "cumbia", "bossa nova", "samba", "flamenco", "afrobeat", "afrobeats", "amapiano", "edm", "house",
+    "techno", "trance", "dubstep", "drum and bass", "garage", "electronica", "electronic", "electro",
+    "ambient", "lo-fi", "downtempo", "new age", "classical", "baroque", "opera", "soundtrack",
+    "worship", "christian", "chanson", "schlager", "anime", "children's music", "comedy",
+], key=lambda family: (-len(family), family))
+
+levels = ["genre", "style", "family"] #from finest to broadest
+max_slices = 20 #including "other"
+other = "other"
+
+def tokens(name):
+    return re.findall(r"[^\s\-]+", name)
+
+@lru_cache(maxsize=100000)
+def classify(genre):
+    #(style, family) of a genre. cached, so each name is only worked out once per process
+    genre_tokens = tokens(genre)
+    #a family spelled out as whole words, the last one wins since qualifiers come first
+    best = None
+    for family in families:
+        family_tokens = tokens(family)
+        size = len(family_tokens)
+        for start in range(len(genre_tokens) - size, -1, -1):
+            if genre_tokens[start:start+size] == family_tokens:
+                if best is None or start > best[0]:
+                    best = (start, size, family)
+                break
+    #otherwise a family starting or ending a word, like "metalcore" or "synthpop".
+    #not just anywhere in it, "demoscene" has nothing to do with emo
+    if best is None:
+        for start in range(len(genre_tokens) - 1, -1, -1):
+            word = genre_tokens[start]
+            family = next((family for family in families if word.startswith(family) or word.endswith(family)), None)
+            if family:
+                best = (start, 1, family)
+                break
+    if best is None:
+        return genre, genre
+    start, size, family = best
+    #the family with the qualifier right before it, spelled as in the genre
+    spans = [match.span() for match in re.finditer(r"[^\s\-]+", genre)]
+    style = genre[spans[max(0, start - 1)][0]:spans[start + size - 1][1]]
+    return style, family
+
+def lookup(genre, level):
+    if level == "genre":
+        return genre
+    style, family = classify(genre)
+    return style if level == "style" else family
+
+
+
+
+def roll_up(ranked, level, slices=max_slices):
+    #[(name, count)] most common first, genres merged at the given level and
+    #everything past the biggest slices - 1 put together as "other"
+    counts = {}
+    for genre, count in ranked:
+        name = lookup(genre, level)
+        counts[name] = counts.get(name, 0) + count
+    merged = sorted(counts.items(), key=lambda item: -item[1])
+    if len(merged) <= slices:
+        return merged
+    kept = merged[:slices - 1]
+    return kept + [(other, sum(count for _, count in merged[slices - 1:]))]
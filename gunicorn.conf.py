@@ -0,0 +1,23 @@
+import os
+
+#load the app once in the master, so every worker forks with matplotlib,
+#its font cache and the chart style already in memory
+preload_app = True
+
+#requests handled at once by each worker. above 1 gunicorn switches to its
+#threaded worker, so a request waiting on spotify doesn't hold up the rest
+threads = int(os.environ.get("POLYVIBE_WEB_THREADS", 1))
+
+def on_starting(server):
+    import app
+    if app.chart_mode == "png":
+        import rendering
+        rendering.warm_up()
+
+def post_worker_init(worker):
+    #the render pool can't be shared across a fork, so each worker starts its own right away
+    import app
+    if app.chart_mode == "png":
+        import rendering
+        if rendering.render_workers:
+            rendering.get_pool()
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import uuid
+import threading
+import metrics
+import contextvars
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from cache import cache_dir, open_db
+from analysis import collect_top, collect_library, collect_playlists, collect_artists, collect_features, top_artists, artist_diversity, top_genres, genre_diversity, features, recommendations, render_charts, prefetch_features, save_library
+
+#a few analyses at a time, each one already fetches pages concurrently
+job_workers = int(os.environ.get("POLYVIBE_JOB_WORKERS", 2))
+job_lifetime = 24*60*60 #finished jobs are kept around this long
+#jobs live in the worker that queued them, one that hasn't been heard from in
+#stale_after seconds went down with its worker. a job's row is updated at least
+#every heartbeat_interval seconds while it runs, and those queued behind it with it
+stale_after = 120
+heartbeat_interval = 15
+
+jobs_path = os.path.join(cache_dir, "jobs.db")
+
+executor = ThreadPoolExecutor(max_workers=job_workers)
+queued = set() #ids of jobs waiting for this worker's executor
+queued_lock = threading.Lock()
+
+def connect():
+    return open_db(jobs_path, ["CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, stage TEXT, percent INTEGER, incomplete INTEGER, plot_data TEXT, updated REAL)"])
+
+
+
+
+def collect_until_done(collect, *done_keys):
+    #collectors checkpoint when their budget runs out, just keep calling them
+    def stage(method_data, plot_data):
+        collect(method_data)
+        while not all(method_data[key] for key in done_keys):
+            collect(method_data)
+    return stage
+
+def prefetch_until(*done_keys):
+    def stage(method_data, plot_data):
+        prefetch_features(method_data, lambda: method_data.get("cancelled") or all(method_data.get(key) for key in done_keys))
+    return stage
+
+def analyze_tracks(method_data, plot_data):
+    features(method_data, plot_data)
+    recommendations(method_data, plot_data)
+
+def render(method_data, plot_data):
+    render_charts(method_data, plot_data)
+
+#(name, message, share of progress, stage, stages it needs). in this order they run one
+#after another, as /loading1 to /loading7 do. a background job starts each one as soon
+#as the stages it needs are done, so features are fetched while playlists and artists
+#are still being collected, and the top artist and genre charts, which only need the
+#top artists, are drawn up while the library is still loading
+stages = [
+    ("collect_top", "Collecting your top songs...", 5, collect_top, []),
+    ("top_artists", "Analyzing your top artists...", 2, top_artists, ["collect_top"]),
+    ("top_genres", "Analyzing your top genres...", 2, top_genres, ["collect_top"]),
+    ("collect_library", "Collecting your saved tracks...", 25, collect_until_done(collect_library, "collected_library"), ["collect_top"]),
+    ("collect_playlists", "Collecting your playlists...", 30, collect_until_done(collect_playlists, "collected_playlists", "collected_tracks"), ["collect_library"]),
+    ("prefetch_features", "Collecting your playlists...", 0, prefetch_until("collected_playlists", "collected_tracks"), ["collect_top"]),
+    ("collect_artists", "Collecting your artists...", 15, collect_until_done(collect_artists, "collected_artists"), ["collect_playlists"]),
+    ("analyze_artists", "Analyzing your artists...", 3, artist_diversity, ["collect_playlists"]),
+    ("analyze_genres", "Analyzing your genres...", 3, genre_diversity, ["collect_artists"]),
+    ("collect_features", "Analyzing your tracks...", 5, collect_until_done(collect_features, "collected_features"), ["collect_playlists", "prefetch_features"]),
+    ("analyze_tracks", "Analyzing your tracks...", 5, analyze_tracks, ["collect_features"]),
+    ("render_charts", "Drawing your charts...", 5, render, ["top_artists", "top_genres", "analyze_artists", "analyze_genres", "analyze_tracks"]),
+    ("save_library", "Drawing your charts...", 0, save_library, ["collect_artists", "analyze_tracks"]),
+]
+
+def run_stage(name, stage, method_data, plot_data):
+    with metrics.stage(name):
+        stage(method_data, plot_data)
+
+def run_stages(method_data, plot_data, progress=None):
+    #runs every stage as soon as the stages it needs are done, calling
+    #progress(message, percent) as they start and finish, and every
+    #heartbeat_interval seconds in between. raises the first error
+    waiting = list(stages)
+    running = {}
+    done = set()
+    percent = 0
+    pool = ThreadPoolExecutor(max_workers=len(stages))
+    try:
+        while waiting or running:
+            for stage in [stage for stage in waiting if all(need in done for need in stage[4])]:
+                waiting.remove(stage)
+                #each on its own copy of the context, so its metrics are counted against its stage
+                running[pool.submit(contextvars.copy_context().run, run_stage, stage[0], stage[3], method_data, plot_data)] = stage
+            if progress:
+                progress([stage[1] for stage in stages if stage in running.values()][0], percent)
+            finished, _ = wait(running, timeout=heartbeat_interval, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, _, share, _, _ = running.pop(future)
+                future.result()
+                done.add(name)
+                percent += share
+    except Exception:
+        method_data["cancelled"] = True #stops prefetching, the rest finish in the background
+        raise
+    finally:
+        pool.shutdown(wait=False)
+
+
+
+
+def enqueue(method_data):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with closing(connect()) as db, db:
+        db.execute("DELETE FROM jobs WHERE updated < ?", (now - job_lifetime,))
+        db.execute("INSERT INTO jobs VALUES (?, 'queued', ?, 0, 0, NULL, ?)", (job_id, stages[0][1], now))
+    with queued_lock:
+        queued.add(job_id)
+    executor.submit(run_job, job_id, method_data)
+    return job_id
+
+def update_job(job_id, status, stage, percent, incomplete_data=False, plot_data=None):
+    if plot_data is not None:
+        plot_data = json.dumps(plot_data)
+    with closing(connect()) as db, db:
+        db.execute("UPDATE jobs SET status = ?, stage = ?, percent = ?, incomplete = ?, plot_data = ?, updated = ? WHERE id = ?",
+            (status, stage, percent, int(incomplete_data), plot_data, time.time(), job_id))
+
+def touch_queued():
+    #queued jobs wait on running ones, so they are kept fresh by them
+    with queued_lock:
+        job_ids = list(queued)
+    if not job_ids:
+        return
+    with closing(connect()) as db, db:
+        db.execute("UPDATE jobs SET updated = ? WHERE id IN ({})".format(",".join("?" * len(job_ids))), [time.time()] + job_ids)
+
+def run_job(job_id, method_data):
+    plot_data = {}
+    percent = 0
+    with queued_lock:
+        queued.discard(job_id)
+    metrics.track(method_data["metrics"])
+    def progress(msg, stage_percent):
+        nonlocal percent
+        percent = stage_percent
+        update_job(job_id, "running", msg, percent)
+        touch_queued()
+    try:
+        run_stages(method_data, plot_data, progress)
+        update_job(job_id, "done", "Done!", 100, method_data["incomplete_data_status"], plot_data)
+        metrics.observe("polyvibe_session_bytes", len(json.dumps(plot_data)), store="jobs")
+        metrics.finish(method_data.pop("metrics", None), mode="job", job_id=job_id, status="done", incomplete=method_data["incomplete_data_status"])
+    except Exception as error:
+        print(type(error))
+        print(error.args)
+        print(error)
+        update_job(job_id, "failed", "Something went wrong", percent)
+        metrics.finish(method_data.pop("metrics", None), mode="job", job_id=job_id, status="failed", error=repr(error))
+    finally:
+        metrics.track(None)
+
+
+
+
+def get_progress(job_id):
+    #what the loading page polls, None if the job is unknown
+    with closing(connect()) as db:
+        row = db.execute("SELECT status, stage, percent, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    status, stage, percent, updated = row
+    if status in ["queued", "running"] and updated < time.time() - stale_after:
+        status, stage = "failed", "Something went wrong"
+    return {"status":status, "stage":stage, "percent":percent}
+
+def get_result(job_id):
+    #(plot_data, incomplete_data) of a finished job, (None, None) otherwise
+    with closing(connect()) as db:
+        row = db.execute("SELECT incomplete, plot_data FROM jobs WHERE id = ? AND status = 'done'", (job_id,)).fetchone()
+    if row is None:
+        return None, None
+    incomplete_data, plot_data = row
+    return json.loads(plot_data), bool(incomplete_data)
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import zipfile
+import numpy as np
+from urllib.parse import quote
+from cache import cache_dir
+from records import *
+
+#a user's collected library on disk as typed column arrays, one .npy file
+#each, with names and ids in string tables. every file can be memory mapped,
+#so the columns an analysis works on load in milliseconds whatever the size of
+#the library, and a user's directory can be read offline with numpy alone.
+#
+#   tracks   track_ids, track_names (strings), track_popularity (int16, 0 unknown),
+#            track_features (float32, one row per track in FEATURE_FIELDS order, nan unknown),
+#            track_artists (ragged, rows of the artist columns)
+#   artists  artist_ids (strings, "" for local files), artist_name_codes (int32, into artist_names),
+#            artist_popularity (int16, -1 unresolved), artist_genres (ragged, into genres)
+#   strings  <name>.npy holds the utf-8 bytes back to back, <name>_offsets.npy where each starts
+#   ragged   <name>.npy holds every row's codes back to back, <name>_offsets.npy where each row starts
+
+libraries_dir = os.path.join(cache_dir, "libraries")
+version = 1
+ttl = 30*24*60*60 #as long as snapshots, a library not saved again in this long is removed
+max_libraries = 20000 #the least recently saved go first past this
+sweep_interval = 60*60 #seconds between sweeps, per worker
+unfinished_lifetime = 60*60 #.new- and .old- directories this old were left by a crash
+swept = 0
+
+def user_path(user_id):
+    return os.path.join(libraries_dir, quote(user_id, safe=""))
+
+def offsets_of(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def string_table(values):
+    encoded = [value.encode() for value in values]
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets_of([len(value) for value in encoded])
+
+def ragged(rows):
+    return np.array([code for row in rows for code in row], dtype=np.int32), offsets_of([len(row) for row in rows])
+
+class Strings:
+    #read only view of a string table, entries are decoded as they are read
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i+1]]).decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+
+def save(user_id, method_data):
+    #writes the collected tracks and artists, replacing what was saved for this user before
+    all_tracks = method_data["all_tracks"]
+    all_artists = method_data["all_artists"]
+    records = list(all_tracks.values())
+
+    #artists on tracks first, then the top artists that aren't on any
+    artist_rows = {}
+    artist_ids = []
+    artist_names = []
+    def artist_row(artist_id, name):
+        key = artist_id or name #local files have artists without ids
+        if key not in artist_rows:
+            artist_rows[key] = len(artist_rows)
+            artist_ids.append(artist_id or "")
+            artist_names.append(name)
+        return artist_rows[key]
+    track_artists = [[artist_row(artist_id, name) for artist_id, name in zip(record[TRACK_ARTIST_IDS], record[TRACK_ARTIST_NAMES])] for record in records]
+    for artist_id, artist in all_artists.items():
+        artist_row(artist_id, artist[ARTIST_NAME])
+
+    name_codes = {}
+    genre_codes = {}
+    resolved = [all_artists.get(artist_id) if artist_id else None for artist_id in artist_ids]
+    features = np.full((len(records), len(FEATURE_FIELDS)), np.nan, dtype=np.float32)
+    for i, record in enumerate(records):
+        if record[TRACK_FEATURES]:
+            features[i] = record[TRACK_FEATURES]
+
+    columns = {
+        "track_ids":string_table(all_tracks),
+        "track_names":string_table(record[TRACK_NAME] for record in records),
+        "track_popularity":np.array([record[TRACK_POPULARITY] or 0 for record in records], dtype=np.int16),
+        "track_features":features,
+        "track_artists":ragged(track_artists),
+        "artist_ids":string_table(artist_ids),
+        "artist_name_codes":np.array([name_codes.setdefault(name, len(name_codes)) for name in artist_names], dtype=np.int32),
+        "artist_names":string_table(name_codes),
+        "artist_popularity":np.array([-1 if artist is None else artist[ARTIST_POPULARITY] for artist in resolved], dtype=np.int16),
+        "artist_genres":ragged([[genre_codes.setdefault(genre, len(genre_codes)) for genre in artist[ARTIST_GENRES]] if artist else [] for artist in resolved]),
+    }
+    columns["genres"] = string_table(genre_codes)
+    meta = {
+        "version":version,
+        "user_id":user_id,
+        "saved":time.time(),
+        "feature_fields":FEATURE_FIELDS,
+        "incomplete":method_data["incomplete_data_status"],
+        "sampled":bool(method_data["page_budget"]),
+        "top_tracks":method_data["tracks"], #track ids, long, medium and short term
+        "top_artists":method_data["artists"], #artist ids, likewise
+    }
+
+    #written next to the old one and swapped in, so readers never see half a library
+    path = user_path(user_id)
+    new_path = os.path.join(libraries_dir, ".new-" + uuid.uuid4().hex)
+    os.makedirs(new_path)
+    for name, column in columns.items():
+        if isinstance(column, tuple):
+            np.save(os.path.join(new_path, name + ".npy"), column[0])
+            np.save(os.path.join(new_path, name + "_offsets.npy"), column[1])
+        else:
+            np.save(os.path.join(new_path, name + ".npy"), column)
+    with open(os.path.join(new_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    old_path = os.path.join(libraries_dir, ".old-" + uuid.uuid4().hex)
+    try:
+        os.rename(path, old_path)
+    except FileNotFoundError:
+        pass
+    os.rename(new_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    sweep()
+
+def sweep():
+    #removes expired libraries, the oldest past max_libraries and what crashed saves left behind
+    global swept
+    now = time.time()
+    if now - swept < sweep_interval:
+        return
+    swept = now
+    libraries = []
+    for entry in os.scandir(libraries_dir):
+        try:
+            saved = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue #removed by another worker meanwhile
+        if entry.name.startswith("."):
+            if saved < now - unfinished_lifetime:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        elif saved < now - ttl:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            libraries.append((saved, entry.path))
+    libraries.sort()
+    for saved, path in libraries[:max(0, len(libraries) - max_libraries)]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def load(user_id):
+    #{column name: memory mapped array or Strings, "meta": {...}}, None if nothing was saved
+    path = user_path(user_id)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        files = {name[:-4]:np.load(os.path.join(path, name), mmap_mode="r") for name in os.listdir(path) if name.endswith(".npy")}
+    except FileNotFoundError:
+        return None
+    if meta["saved"] < time.time() - ttl:
+        return None #not swept yet
+    library = {"meta":meta}
+    for name in ["track_ids", "track_names", "artist_ids", "artist_names", "genres"]:
+        library[name] = Strings(files.pop(name), files.pop(name + "_offsets"))
+    library.update(files)
+    return library
+
+
+
+
+def export(path, user_ids=None):
+    #one zip of every user's directory, or just those given, for offline analysis.
+    #path can also be a file object
+    if user_ids is None:
+        directories = [name for name in os.listdir(libraries_dir) if not name.startswith(".")] if os.path.isdir(libraries_dir) else []
+    else:
+        directories = [os.path.basename(user_path(user_id)) for user_id in user_ids]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for directory in directories:
+            for name in sorted(os.listdir(os.path.join(libraries_dir, directory))):
+                archive.write(os.path.join(libraries_dir, directory, name), os.path.join(directory, name))
+
+if __name__ == "__main__":
+    #python library.py libraries.zip [user_id ...]
+    export(sys.argv[1], sys.argv[2:] or None)
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import contextvars
+from contextlib import closing, contextmanager
+from collections import Counter
+from cache import cache_dir, open_db
+
+#counters and histograms for /metrics. each process keeps its own and adds
+#them into a shared sqlite table now and then, so whichever worker gets
+#scraped reports the numbers of every worker on the machine
+
+metrics_path = os.path.join(cache_dir, "metrics.db")
+flush_interval = 10 #seconds
+
+#upper bounds of each histogram's buckets
+buckets = {
+    "polyvibe_spotify_request_seconds":[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    "polyvibe_stage_seconds":[0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300],
+    "polyvibe_chart_render_seconds":[0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    "polyvibe_session_bytes":[10000, 100000, 250000, 1000000, 2500000, 10000000],
+}
+
+descriptions = {
+    "polyvibe_spotify_requests_total":"Requests to the Spotify API, by stage, endpoint and status code.",
+    "polyvibe_spotify_request_seconds":"Latency of requests to the Spotify API, by endpoint.",
+    "polyvibe_pages_fetched_total":"Pages successfully fetched from the Spotify API, by stage and endpoint.",
+    "polyvibe_stage_seconds":"Wall time spent in each stage of an analysis.",
+    "polyvibe_chart_render_seconds":"Time taken to render charts on the server, for a whole analysis or a single export.",
+    "polyvibe_session_bytes":"Serialized size of a finished analysis, by where it is stored.",
+    "polyvibe_analyses_total":"Finished analyses, by mode and status.",
+}
+
+pending = Counter()
+pending_lock = threading.Lock()
+tally_lock = threading.Lock()
+last_flush = time.time()
+
+#the stage being run and the tally of the analysis it belongs to. spotify.get_pages
+#copies them onto its threads, so calls are counted against the right analysis
+current_stage = contextvars.ContextVar("current_stage", default="")
+current_tally = contextvars.ContextVar("current_tally", default=None)
+
+def connect():
+    return open_db(metrics_path, ["CREATE TABLE IF NOT EXISTS metrics (name TEXT, labels TEXT, value REAL, PRIMARY KEY (name, labels))"])
+
+
+
+
+def add(name, labels, value):
+    #labels is a sorted tuple of (label, value) pairs
+    global last_flush
+    with pending_lock:
+        pending[name, labels] += value
+        due = time.time() - last_flush > flush_interval
+    if due:
+        flush()
+
+def tally_add(name, labels, value):
+    #the tally is a plain dict, so in the /loadingN chain it lives in method_data
+    tally = current_tally.get()
+    if tally is None:
+        return
+    key = name.replace("polyvibe_", "").replace("_total", "")
+    label = " ".join(str(label_value) for _, label_value in labels) or "all"
+    with tally_lock:
+        counts = tally.setdefault(key, {})
+        counts[label] = counts.get(label, 0) + value
+
+def count(name, value=1, **labels):
+    labels = tuple(sorted(labels.items()))
+    add(name, labels, value)
+    tally_add(name, labels, value)
+
+def observe(name, value, **labels):
+    labels = tuple(sorted(labels.items()))
+    for bound in buckets[name]:
+        add(name + "_bucket", labels + (("le", str(bound)),), int(value <= bound))
+    add(name + "_bucket", labels + (("le", "+Inf"),), 1)
+    add(name + "_sum", labels, value)
+    add(name + "_count", labels, 1)
+    tally_add(name, labels, value)
+
+def flush():
+    global last_flush
+    with pending_lock:
+        values = list(pending.items())
+        pending.clear()
+        last_flush = time.time()
+    if not values:
+        return
+    try:
+        with closing(connect()) as db, db:
+            db.executemany("INSERT INTO metrics VALUES (?, ?, ?) ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                [(name, json.dumps(labels), value) for (name, labels), value in values])
+    except sqlite3.Error as error:
+        print("Metrics unavailable: {}".format(error))
+
+
+
+
+def track(tally):
+    #count what follows against this analysis, None stops tracking
+    current_tally.set(tally)
+
+def new_tally():
+    return {"started":time.time(), "stage_seconds":{}}
+
+@contextmanager
+def stage(name):
+    #time a stage of the analysis, in the /loadingN chain it may take several requests
+    token = current_stage.set(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+        tally = current_tally.get()
+        if tally is not None:
+            tally["stage_seconds"][name] = tally["stage_seconds"].get(name, 0) + time.time() - start
+
+def finish(tally, **fields):
+    #record a finished analysis and log it as one json line
+    if tally is None:
+        return
+    stage_seconds = tally.pop("stage_seconds")
+    for name, seconds in stage_seconds.items():
+        observe("polyvibe_stage_seconds", seconds, stage=name)
+    count("polyvibe_analyses_total", mode=fields.get("mode", ""), status=fields.get("status", ""))
+    line = {"event":"analysis", "seconds":round(time.time() - tally.pop("started"), 3)}
+    line.update(fields)
+    line["stage_seconds"] = {name:round(seconds, 3) for name, seconds in stage_seconds.items()}
+    line.update(tally)
+    print(json.dumps(line, sort_keys=True), flush=True)
+    flush()
+
+
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"')) for label, value in labels) + "}"
+
+def sample_order(sample):
+    #buckets in increasing order, each series together
+    name, labels, value = sample
+    bound = dict(labels).get("le")
+    return [label for label in labels if label[0] != "le"], name, float(bound or 0)
+
+def exposition():
+    #every worker's metrics in the prometheus text format
+    flush()
+    try:
+        with closing(connect()) as db:
+            rows = db.execute("SELECT name, labels, value FROM metrics ORDER BY name, labels").fetchall()
+    except sqlite3.Error as error:
+        print("Metrics unavailable: {}".format(error))
+        rows = []
+    families = {}
+    for name, labels, value in rows:
+        family = name
+        for suffix in ["_bucket", "_sum", "_count"]:
+            if name.endswith(suffix) and name[:-len(suffix)] in buckets:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, [tuple(pair) for pair in json.loads(labels)], value))
+    lines = []
+    for family in sorted(families):
+        lines.append("# HELP {} {}".format(family, descriptions.get(family, family)))
+        lines.append("# TYPE {} {}".format(family, "histogram" if family in buckets else "counter"))
+        for name, labels, value in sorted(families[family], key=sample_order):
+            lines.append("{}{} {}".format(name, format_labels(labels), repr(float(value))))
+    return "\n".join(lines) + "\n"
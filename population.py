@@ -0,0 +1,100 @@
+import os
+import math
+import time
+import sqlite3
+from contextlib import closing
+from cache import cache_dir, open_db
+
+#how a user's genre and artist mix compares with everyone analyzed before.
+#genres and artists are interned into a shared vocabulary, each user's shares
+#are kept in a sparse user x term table, and each term's shares across users
+#are kept as counts over log spaced buckets. a percentile is then a sum over a
+#few dozen rows however many users are stored, and adding or replacing a
+#user only touches that user's buckets
+
+population_path = os.path.join(cache_dir, "population.db")
+
+max_terms = 200 #most common genres or artists kept per user
+buckets_per_octave = 8 #shares about 9% apart land in different buckets
+smallest_share = 2**-16
+
+def connect():
+    return open_db(population_path, [
+        "CREATE TABLE IF NOT EXISTS vocabulary (id INTEGER PRIMARY KEY, kind TEXT, name TEXT, UNIQUE (kind, name))",
+        "CREATE TABLE IF NOT EXISTS users (kind TEXT, user TEXT, updated REAL, PRIMARY KEY (kind, user))",
+        "CREATE TABLE IF NOT EXISTS sizes (kind TEXT PRIMARY KEY, users INTEGER)",
+        "CREATE TABLE IF NOT EXISTS shares (user TEXT, term INTEGER, share REAL, PRIMARY KEY (user, term))",
+        "CREATE TABLE IF NOT EXISTS distribution (term INTEGER, bucket INTEGER, users INTEGER, PRIMARY KEY (term, bucket))",
+    ], isolation_level=None)
+
+
+
+
+def bucket(share):
+    return int((math.log2(max(share, smallest_share)) - math.log2(smallest_share)) * buckets_per_octave)
+
+def shares(ranked):
+    #[(name, share)] of the max_terms most common in [(name, count)]
+    total = sum(count for _, count in ranked)
+    return [(name, count / total) for name, count in ranked[:max_terms]]
+
+def intern(db, kind, names):
+    db.executemany("INSERT OR IGNORE INTO vocabulary (kind, name) VALUES (?, ?)", [(kind, name) for name in names])
+    ids = {}
+    for i in range(0, len(names), 500):
+        chunk = names[i:i+500]
+        rows = db.execute("SELECT name, id FROM vocabulary WHERE kind = ? AND name IN ({})".format(",".join("?" * len(chunk))), [kind] + chunk)
+        ids.update(rows)
+    return ids
+
+def add_to_distribution(db, rows, step):
+    #rows are (term, share), step is 1 to add them and -1 to take them out
+    db.executemany("INSERT INTO distribution VALUES (?, ?, ?) ON CONFLICT (term, bucket) DO UPDATE SET users = users + excluded.users",
+        [(term, bucket(share), step) for term, share in rows])
+
+def record(db, kind, user, user_shares, ids):
+    #replace what we had for this user with their latest mix
+    old = db.execute("SELECT term, share FROM shares JOIN vocabulary ON vocabulary.id = shares.term WHERE user = ? AND kind = ?", (user, kind)).fetchall()
+    add_to_distribution(db, old, -1)
+    db.executemany("DELETE FROM shares WHERE user = ? AND term = ?", [(user, term) for term, _ in old])
+    rows = [(ids[name], share) for name, share in user_shares]
+    db.executemany("INSERT INTO shares VALUES (?, ?, ?)", [(user, term, share) for term, share in rows])
+    add_to_distribution(db, rows, 1)
+    known = db.execute("SELECT 1 FROM users WHERE kind = ? AND user = ?", (kind, user)).fetchone()
+    db.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", (kind, user, time.time()))
+    if not known:
+        db.execute("INSERT INTO sizes VALUES (?, 1) ON CONFLICT (kind) DO UPDATE SET users = users + 1", (kind,))
+
+def percentile(db, term, share, others, included):
+    #share of the other users with a smaller share of term, ties in the same bucket count half
+    below, same, with_term = db.execute("SELECT TOTAL(CASE WHEN bucket < ? THEN users END), TOTAL(CASE WHEN bucket = ? THEN users END), TOTAL(users) FROM distribution WHERE term = ?",
+        (bucket(share), bucket(share), term)).fetchone()
+    if included:
+        same -= 1
+        with_term -= 1
+    return 100 * (below + same / 2 + others - with_term) / others
+
+
+
+
+def compare(kind, ranked, user=None, count=10):
+    #[name, share %, percentile] of the count most common in [(name, count)] against
+    #every other user. with a user id, their mix is also added to the population
+    user_shares = shares(ranked)
+    if not user_shares:
+        return []
+    try:
+        with closing(connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            ids = intern(db, kind, [name for name, _ in user_shares])
+            if user:
+                record(db, kind, user, user_shares, ids)
+            db.execute("COMMIT")
+            size = db.execute("SELECT users FROM sizes WHERE kind = ?", (kind,)).fetchone()
+            others = (size[0] if size else 0) - bool(user)
+            if others <= 0:
+                return []
+            return [[name, round(100*share, 2), round(percentile(db, ids[name], share, others, bool(user)))] for name, share in user_shares[:count]]
+    except sqlite3.Error as error:
+        print("Population index unavailable: {}".format(error))
+        return []
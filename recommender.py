@@ -0,0 +1,120 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+from contextlib import closing
+from cache import cache_dir, open_db
+from records import *
+
+#track recommendations from the audio features of every track analyzed here,
+#without a call to spotify. tracks go into a shared sqlite catalog once, and
+#each worker keeps their features as one float32 matrix, so finding the
+#tracks nearest a user's average is a single vectorized pass
+
+catalog_path = os.path.join(cache_dir, "catalog.db")
+
+max_tracks = 1000000 #oldest tracks are dropped past this, 36 MB of features per worker
+min_tracks = 5000 #below this spotify's /recommendations does better
+refresh_interval = 60 #seconds between looks for tracks other workers added
+candidates_per_pick = 20 #nearest tracks read from the catalog for each one returned
+
+#features compared, each over its spread in the catalog so they weigh the same
+compared_fields = ["valence", "energy", "danceability", "acousticness", "instrumentalness", "liveness", "speechiness", "loudness", "tempo"]
+compared = [FEATURE_FIELDS.index(field) for field in compared_fields]
+
+index_lock = threading.Lock()
+index = {
+    "rowids":np.empty(0, dtype=np.int64),
+    "scaled":np.empty((0, len(compared)), dtype=np.float32), #features over their standard deviation
+    "norms":np.empty(0, dtype=np.float32), #squared length of each scaled row
+    "std":np.ones(len(compared), dtype=np.float32),
+    "checked":0,
+}
+
+def connect():
+    return open_db(catalog_path, ["CREATE TABLE IF NOT EXISTS catalog (id INTEGER PRIMARY KEY, track TEXT UNIQUE, name TEXT, artists TEXT, features BLOB)"])
+
+
+
+
+def add(tracks):
+    #tracks is {track id: track record}, those without features are left out
+    rows = [(track_id, record[TRACK_NAME], ", ".join(record[TRACK_ARTIST_NAMES]), np.array([record[TRACK_FEATURES][i] for i in compared], dtype=np.float32).tobytes())
+        for track_id, record in tracks.items() if record[TRACK_FEATURES] and not is_local(track_id)]
+    if not rows:
+        return
+    try:
+        with closing(connect()) as db, db:
+            db.executemany("INSERT OR IGNORE INTO catalog (track, name, artists, features) VALUES (?, ?, ?, ?)", rows)
+            db.execute("DELETE FROM catalog WHERE id <= (SELECT MAX(id) FROM catalog) - ?", (max_tracks,))
+    except sqlite3.Error as error:
+        print("Catalog unavailable: {}".format(error))
+
+def refresh():
+    #appends tracks added since the last look and forgets the ones dropped
+    now = time.time()
+    with index_lock:
+        if now - index["checked"] < refresh_interval:
+            return
+        index["checked"] = now
+        last = int(index["rowids"][-1]) if len(index["rowids"]) else 0
+        try:
+            with closing(connect()) as db:
+                first = db.execute("SELECT MIN(id) FROM catalog").fetchone()[0] or 0
+                rows = db.execute("SELECT id, features FROM catalog WHERE id > ? ORDER BY id", (last,)).fetchall()
+        except sqlite3.Error as error:
+            print("Catalog unavailable: {}".format(error))
+            return
+        kept = index["rowids"] >= first
+        rowids = np.concatenate([index["rowids"][kept], np.array([rowid for rowid, _ in rows], dtype=np.int64)])
+        features = np.concatenate([index["scaled"][kept] * index["std"], np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32).reshape(-1, len(compared))])
+        std = features.std(axis=0) + 1e-6 if len(rowids) else index["std"]
+        scaled = features / std
+        index["rowids"] = rowids
+        index["scaled"] = scaled
+        index["norms"] = (scaled ** 2).sum(axis=1)
+        index["std"] = std
+
+
+
+
+def recommend(centroid, saved, count=20):
+    #[[name, artists]] of the count tracks nearest centroid, a full feature vector,
+    #one per artist and none that saved(track id) is true for. empty when the
+    #catalog is too small to be worth it
+    refresh()
+    with index_lock:
+        rowids, scaled, norms, std = index["rowids"], index["scaled"], index["norms"], index["std"]
+    if len(rowids) < min_tracks or centroid is None:
+        return []
+    target = np.array([centroid[i] for i in compared], dtype=np.float32) / std
+    #squared distance in standard deviations, less the target's length which is the same for every row
+    distances = norms - 2 * (scaled @ target)
+    nearest = min(len(distances), count * candidates_per_pick)
+    order = np.argpartition(distances, nearest - 1)[:nearest]
+    order = order[np.argsort(distances[order])]
+    try:
+        with closing(connect()) as db:
+            chosen = rowids[order].tolist()
+            found = {}
+            for i in range(0, len(chosen), 500):
+                chunk = chosen[i:i+500]
+                found.update((rowid, (track, name, artists)) for rowid, track, name, artists
+                    in db.execute("SELECT id, track, name, artists FROM catalog WHERE id IN ({})".format(",".join("?" * len(chunk))), chunk))
+    except sqlite3.Error as error:
+        print("Catalog unavailable: {}".format(error))
+        return []
+    picks = []
+    seen = set()
+    for rowid in chosen:
+        if rowid not in found:
+            continue #dropped from the catalog since the last refresh
+        track, name, artists = found[rowid]
+        if artists in seen or saved(track):
+            continue
+        seen.add(artists)
+        picks.append([name, artists])
+        if len(picks) == count:
+            break
+    return picks
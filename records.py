@@ -0,0 +1,38 @@
+#compact records for the spotify objects we keep around, holding only the
+#fields the analysis reads. they are plain lists keyed by spotify id so they
+#stay small in the session and in the caches, whichever serializer is used
+
+TRACK_NAME, TRACK_POPULARITY, TRACK_ARTIST_IDS, TRACK_ARTIST_NAMES, TRACK_FEATURES = range(5)
+ARTIST_NAME, ARTIST_GENRES, ARTIST_POPULARITY = range(3)
+
+#audio feature vectors hold these fields in this order
+FEATURE_FIELDS = ["valence", "energy", "danceability", "acousticness", "instrumentalness", "liveness",
+    "speechiness", "loudness", "tempo", "key", "mode", "time_signature", "duration_ms"]
+VALENCE, ENERGY, DANCEABILITY = range(3)
+
+def track_key(track):
+    #local files have no id, but their uri is unique
+    return track["id"] or track["uri"]
+
+def is_local(track_key):
+    return track_key.startswith("spotify:local:")
+
+def track_record(track):
+    artists = [artist for artist in track["artists"] if artist["name"]]
+    return [
+        track["name"],
+        track["popularity"],
+        [artist["id"] for artist in artists],
+        [artist["name"] for artist in artists],
+        None, #audio features, filled in once fetched
+    ]
+
+def artist_record(artist):
+    return [
+        artist["name"],
+        artist["genres"],
+        artist["popularity"],
+    ]
+
+def feature_record(audio_object):
+    return [audio_object[field] for field in FEATURE_FIELDS]
@@ -0,0 +1,169 @@
+import io
+import os
+import base64
+import threading
+import multiprocessing
+import numpy as np
+import matplotlib
+import matplotlib.style
+from urllib.parse import quote
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+#charts only go through the object oriented api, so the style is the one
+#piece of global matplotlib state and it is set once per process
+matplotlib.style.use('ggplot')
+matplotlib.rc("font", family="serif")
+tab20 = matplotlib.colormaps["tab20"]
+tab20_colors = [tab20(i) for i in np.linspace(0,1,20)]
+
+#0 renders in the calling process
+render_workers = int(os.environ.get("POLYVIBE_RENDER_WORKERS", min(4, os.cpu_count() or 1)))
+
+pool = None
+pool_lock = threading.Lock()
+#figures are never shared, but text layout and font caches are, so a threaded
+#web worker draws one chart at a time. rendering holds the gil anyway
+render_lock = threading.Lock()
+
+def get_pool():
+    #started on first use so each web worker gets its own, then kept warm
+    global pool
+    with pool_lock:
+        if pool is not None:
+            return pool
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["rendering"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=context)
+        for _ in range(render_workers):
+            pool.submit(warm_up)
+    return pool
+
+def drop_pool(broken):
+    #a render process died, killed for memory most likely, and took the pool
+    #with it. the next get_pool starts another
+    global pool
+    with pool_lock:
+        if pool is broken:
+            pool = None
+    broken.shutdown(wait=False)
+
+def warm_up():
+    #draw one chart of every kind, so fonts are found and text layout is
+    #cached before the first real report. gunicorn does this in the master
+    for spec in [
+        {"kind":"bump", "count":1, "artists":["Artist"], "places":[[1, 1, 1]]},
+        {"kind":"stack", "genres":["genre"], "props":[[1, 1, 1]]},
+        {"kind":"pie", "labels":["genre"], "counts":[1], "legend":["1.  genre (100%)"]},
+        {"kind":"hist", "range":[0,1], "counts":[1]},
+    ]:
+        render_png(spec)
+
+
+
+
+def save_png(fig):
+    img = io.BytesIO()
+    fig.savefig(img, format='png', bbox_inches='tight')
+    return img.getvalue()
+
+def tab20_axes(fig):
+    ax = fig.subplots()
+    ax.set_prop_cycle('color', tab20_colors)
+    return ax
+
+
+
+
+def render_bump(spec):
+    #rank of each artist over the three terms
+    count = spec["count"]
+    ha = {
+        0:"left",
+        1:"center",
+        2:"right"
+    }
+    fig = Figure(figsize=(10, 6))
+    ax = tab20_axes(fig)
+    for artist, places in zip(spec["artists"], spec["places"]):
+        ax.plot(places)
+        for i,place in enumerate(places[::-1]):
+            if place <= count:
+                ax.annotate(artist, (2-i,place), ha=ha[2-i])
+                break
+    ax.set_yticks(list(range(1,count+1)))
+    ax.yaxis.tick_right()
+    ax.set_xticks([0,1,2])
+    ax.set_xticklabels(["Long Term", "Medium Term", "Short Term"])
+    ax.set_ylim([0.5,count+0.5])
+    ax.invert_yaxis()
+    return fig
+
+def render_stack(spec):
+    #share of each genre over the three terms
+    fig = Figure(figsize=(10, 6))
+    ax = tab20_axes(fig)
+    ax.stackplot([0,1,2], *spec["props"], labels=spec["genres"])
+    ax.yaxis.tick_right()
+    ax.set_yticks([num/100 for num in range(0,100+1, 10)])
+    ax.set_yticklabels([str(num)+"%" for num in range(0,100+1,10)])
+    ax.set_xticks([-0.75, 0,1,2])
+    ax.set_xticklabels(["", "Long Term", "Medium Term", "Short Term"])
+    ax.set_ylim([0,1])
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles[::-1][:29], labels[::-1][:29], loc='center left', fontsize=8)
+    return fig
+
+def render_pie(spec):
+    counts = spec["counts"]
+    fig = Figure(figsize=(10, 6))
+    ax = tab20_axes(fig)
+    ax.pie(counts, explode=[0.1]+[0]*(len(counts)-1), labels=spec["labels"], textprops={'fontsize': 9}, startangle=110)
+    ax.legend(fontsize=7, labels=spec["legend"], loc="upper right")
+    ax.axis('equal')
+    return fig
+
+def render_hist(spec):
+    #counts are already binned, evenly over range
+    counts = spec["counts"]
+    edges = np.linspace(spec["range"][0], spec["range"][1], len(counts)+1)
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.hist(edges[:-1], bins=edges, weights=counts, color='#8D7EF2')
+    return fig
+
+renderers = {
+    "bump":render_bump,
+    "stack":render_stack,
+    "pie":render_pie,
+    "hist":render_hist,
+}
+
+def render_png(spec):
+    with render_lock:
+        return save_png(renderers[spec["kind"]](spec))
+
+def render(spec):
+    #url quoted base64, ready to inline in the page
+    return quote(base64.b64encode(render_png(spec)).decode())
+
+def render_all(specs):
+    #{key: spec} -> {key: url quoted base64 png}, rendered concurrently
+    keys = list(specs)
+    charts = [specs[key] for key in keys]
+    if not render_workers:
+        return dict(zip(keys, map(render, charts)))
+    #once more on a fresh pool if a render process dies, a chart that kills it twice is an error
+    for attempt in range(2):
+        current = get_pool()
+        try:
+            return dict(zip(keys, current.map(render, charts)))
+        except BrokenProcessPool:
+            print("Render pool broken, attempt {}".format(attempt + 1))
+            drop_pool(current)
+            if attempt:
+                raise
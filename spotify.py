@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+import contextvars
+import requests
+import metrics
+from contextlib import closing
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from cache import cache_dir, open_db
+
+try:
+    import orjson #optional, parses a good deal faster
+except ImportError:
+    orjson = None
+
+#every call to the spotify web api goes through here, so that retries,
+#rate limiting and concurrency are handled the same way for every collector
+
+#pointed elsewhere by the benchmarks
+base = os.environ.get("SPOTIFY_API_BASE", "https://api.spotify.com/v1")
+
+max_workers = 8 #concurrent requests to spotify, per web worker
+max_retries = 4
+max_retry_after = 10 #don't sit out a longer 429 than this, the report is marked incomplete instead
+backoff = 0.5 #seconds, doubled on every retry
+request_timeout = 10 #seconds to connect, and between bytes of the response, before a request is retried
+
+#requests per second allowed across every worker on the machine, and how many can burst at once
+rate = float(os.environ.get("POLYVIBE_SPOTIFY_RATE", 10))
+burst = float(os.environ.get("POLYVIBE_SPOTIFY_BURST", 20))
+
+#keep-alive connections, one session per thread since requests doesn't promise
+#a session is safe to share. the page fetching threads live as long as the
+#process, and so do gunicorn's request threads, so connections are still reused
+local = threading.local()
+executor = ThreadPoolExecutor(max_workers=max_workers)
+
+def session():
+    try:
+        return local.http
+    except AttributeError:
+        local.http = requests.Session()
+        local.http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        return local.http
+
+
+
+
+class TokenBucket:
+    #rate limit shared by every process through an sqlite file. a 429 also
+    #blocks everyone else until its Retry-After has passed
+
+    def __init__(self, name, rate, burst):
+        self.path = os.path.join(cache_dir, name + ".db")
+        self.rate = rate
+        self.burst = burst
+
+    def connect(self):
+        db = open_db(self.path, [
+            "CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)",
+            ("INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, 0)", (self.burst, time.time())),
+        ], isolation_level=None)
+        db.execute("PRAGMA synchronous=OFF") #losing the bucket in a crash is harmless
+        return db
+
+    def take(self):
+        #seconds to wait before trying again, 0 once a token was taken
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            tokens, updated, blocked_until = db.execute("SELECT tokens, updated, blocked_until FROM bucket WHERE id = 0").fetchone()
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if now < blocked_until:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            db.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 0", (tokens, now))
+            db.execute("COMMIT")
+        return wait
+
+    def acquire(self, deadline=None):
+        #False if no token comes free before deadline
+        try:
+            wait = self.take()
+            while wait:
+                if deadline is not None and time.time() + wait > deadline:
+                    return False
+                time.sleep(wait)
+                wait = self.take()
+        except sqlite3.Error as error:
+            print("Rate limiter unavailable: {}".format(error))
+        return True
+
+    def block(self, seconds):
+        try:
+            with closing(self.connect()) as db:
+                db.execute("UPDATE bucket SET blocked_until = MAX(blocked_until, ?) WHERE id = 0", (time.time() + seconds,))
+        except sqlite3.Error as error:
+            print("Rate limiter unavailable: {}".format(error))
+
+
+
+
+class ConcurrencyLimit:
+    #additive increase, multiplicative decrease on the requests in flight, so
+    #concurrency backs off when we get 429s and creeps back up when we don't
+
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.limit = float(ceiling)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(1, self.limit / 2)
+
+    def succeeded(self):
+        with self.condition:
+            grown = min(self.ceiling, self.limit + 1 / self.limit)
+            if int(grown) > int(self.limit):
+                self.condition.notify()
+            self.limit = grown
+
+bucket = TokenBucket("ratelimit", rate, burst)
+concurrency = ConcurrencyLimit(max_workers)
+
+
+
+
+def retry_after(response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+def endpoint(url):
+    #the path with ids taken out, so every playlist counts as one endpoint
+    parts = urlsplit(url).path.split("/")[2:]
+    for i in range(1, len(parts) - 1):
+        if parts[i-1] in ["playlists", "users", "artists", "albums"]:
+            parts[i] = "{id}"
+    return "/" + "/".join(parts)
+
+def gateway_timeout(url):
+    #stands in for a response that never came
+    response = requests.Response()
+    response.status_code = 504
+    response.url = url
+    return response
+
+def timed_out(url):
+    #there was no time left to get one
+    metrics.count("polyvibe_spotify_requests_total", stage=metrics.current_stage.get(), endpoint=endpoint(url), status="deadline")
+    return gateway_timeout(url)
+
+def past(deadline, seconds):
+    return deadline is not None and time.time() + seconds > deadline
+
+def get(url, params=None, headers=None, deadline=None):
+    #like requests.get, but waits its turn, honors Retry-After and retries
+    #5xx and connection errors with jittered exponential backoff. given a
+    #deadline (a time.time()), it returns the failed response, or a 504 of its
+    #own, rather than wait or send a request that could run past it. never
+    #raises, a connection that keeps failing also ends in a 504
+    path = endpoint(url)
+    for attempt in range(max_retries + 1):
+        if not bucket.acquire(deadline):
+            return timed_out(url)
+        start = time.time()
+        try:
+            with concurrency:
+                timeout = request_timeout if deadline is None else min(request_timeout, deadline - time.time())
+                if timeout <= 0:
+                    return timed_out(url)
+                response = session().get(url, params=params, headers=headers, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics.count("polyvibe_spotify_requests_total", stage=metrics.current_stage.get(), endpoint=path, status="error")
+            pause = random.uniform(0, backoff * 2**attempt)
+            if past(deadline, pause):
+                return timed_out(url)
+            if attempt == max_retries:
+                return gateway_timeout(url) #already counted as an error
+            time.sleep(pause)
+            continue
+        metrics.observe("polyvibe_spotify_request_seconds", time.time() - start, endpoint=path)
+        metrics.count("polyvibe_spotify_requests_total", stage=metrics.current_stage.get(), endpoint=path, status=response.status_code)
+        if response.status_code == 429:
+            concurrency.throttled()
+            wait = retry_after(response)
+            if wait is None:
+                wait = random.uniform(0, backoff * 2**attempt)
+            if wait > max_retry_after or attempt == max_retries:
+                return response
+            bucket.block(wait)
+            wait += random.uniform(0, backoff)
+            if past(deadline, wait):
+                return response
+            time.sleep(wait)
+        elif response.status_code >= 500 and attempt < max_retries:
+            pause = random.uniform(0, backoff * 2**attempt)
+            if past(deadline, pause):
+                return response
+            time.sleep(pause)
+        else:
+            concurrency.succeeded()
+            return response
+    return response
+
+def loads(response):
+    #parse the body straight from bytes, skipping the decode to str
+    if orjson:
+        return orjson.loads(response.content)
+    return json.loads(response.content)
+
+def get_pages(pages, headers, deadline=None):
+    #fetch (url, params) pairs concurrently, responses are returned in order.
+    #each runs in a copy of the caller's context so metrics know whose page it is
+    def get_page(page):
+        url, params = page
+        response = get(url, params=params, headers=headers, deadline=deadline)
+        if response.status_code == requests.codes.ok:
+            metrics.count("polyvibe_pages_fetched_total", stage=metrics.current_stage.get(), endpoint=endpoint(url))
+        return response
+    contexts = [contextvars.copy_context() for _ in pages]
+    return list(executor.map(lambda context, page: context.run(get_page, page), contexts, pages))
@@ -0,0 +1,100 @@
+// draws the chart specs built in analysis.py, the same data
+// the server would otherwise render into pngs
+
+const tab20 = [
+    "#1f77b4", "#aec7e8", "#ff7f0e", "#ffbb78", "#2ca02c",
+    "#98df8a", "#d62728", "#ff9896", "#9467bd", "#c5b0d5",
+    "#8c564b", "#c49c94", "#e377c2", "#f7b6d2", "#7f7f7f",
+    "#c7c7c7", "#bcbd22", "#dbdb8d", "#17becf", "#9edae5"
+];
+const terms = ["Long Term", "Medium Term", "Short Term"];
+
+Chart.defaults.font.family = "serif";
+Chart.defaults.maintainAspectRatio = false;
+
+function color(i) {
+    return tab20[i % tab20.length];
+}
+
+function drawBump(canvas, spec) {
+    // rank of each artist over the three terms
+    new Chart(canvas, {
+        type: "line",
+        data: {
+            labels: terms,
+            datasets: spec.artists.map((artist, i) => ({
+                label: artist,
+                data: spec.places[i],
+                borderColor: color(i),
+                backgroundColor: color(i),
+            })),
+        },
+        options: {
+            plugins: {legend: {display: false}},
+            scales: {y: {reverse: true, min: 0.5, max: spec.count + 0.5, position: "right", ticks: {stepSize: 1}}},
+        },
+    });
+}
+
+function drawStack(canvas, spec) {
+    // share of each genre over the three terms
+    new Chart(canvas, {
+        type: "line",
+        data: {
+            labels: terms,
+            // stacked in reverse, each band filled down to the one drawn before it
+            datasets: spec.genres.map((genre, i) => ({
+                label: genre,
+                data: spec.props[i],
+                pointRadius: 0,
+                borderColor: color(i),
+                backgroundColor: color(i),
+            })).reverse().map((dataset, i) => ({...dataset, fill: i == 0 ? "origin" : "-1"})),
+        },
+        options: {
+            plugins: {legend: {position: "left", labels: {boxWidth: 10, font: {size: 8}}}},
+            scales: {y: {stacked: true, min: 0, max: 1, position: "right", ticks: {format: {style: "percent"}}}},
+        },
+    });
+}
+
+function drawPie(canvas, spec) {
+    new Chart(canvas, {
+        type: "pie",
+        data: {
+            labels: spec.counts.map((count, i) => spec.legend[i] || ""),
+            datasets: [{
+                data: spec.counts,
+                backgroundColor: spec.counts.map((count, i) => color(i)),
+                offset: spec.counts.map((count, i) => i == 0 ? 20 : 0),
+            }],
+        },
+        options: {
+            plugins: {legend: {position: "right", labels: {boxWidth: 10, font: {size: 8}, filter: (item) => item.text}}},
+        },
+    });
+}
+
+function drawHist(canvas, spec) {
+    // counts are already binned, evenly over range
+    const width = (spec.range[1] - spec.range[0]) / spec.counts.length;
+    new Chart(canvas, {
+        type: "bar",
+        data: {
+            labels: spec.counts.map((count, i) => (spec.range[0] + i * width).toFixed(2)),
+            datasets: [{data: spec.counts, backgroundColor: "#8D7EF2", barPercentage: 1, categoryPercentage: 1}],
+        },
+        options: {plugins: {legend: {display: false}}},
+    });
+}
+
+const drawers = {bump: drawBump, stack: drawStack, pie: drawPie, hist: drawHist};
+
+function drawCharts(charts) {
+    for (const key in charts) {
+        const canvas = document.getElementById(key);
+        if (canvas) {
+            drawers[charts[key].kind](canvas, charts[key]);
+        }
+    }
+}